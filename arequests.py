@@ -3,27 +3,89 @@ arequests
 ~~~~~~~~~
 
 This module contains an asynchronous replica of ``requests.api``, powered
-by Python's built-in threading module. All API methods return a ``Request``
-instance (as opposed to ``Response``). A list of requests can be sent with
-``map()``.
+by a pool of long-lived threads from ``tmap``. All API methods return a
+``Request`` instance (as opposed to ``Response``). A list of requests can be
+sent with ``map()``.
 """
 
+import collections
+import email.utils
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+import cache
+import throttle
 import tmap
+import Queue as queue
 
-from requests import api
+from requests import api, exceptions, models, sessions
+from requests.packages.urllib3.response import HTTPResponse
 
 __all__ = (
     'map', 'imap',
     'get', 'options', 'head', 'post', 'put', 'patch', 'delete', 'request'
 )
 
-def patched(f):
-    """Patches a given API function to not send."""
+# the most connections kept open to any one host
+POOL_MAXSIZE = 10
+
+# one session per host, so connections to it are kept alive and reused
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def host_of(url):
+    """Return the lowercase host (and port, if any) of a URL."""
+
+    return urlparse.urlsplit(url).netloc.lower()
+
+def session_for(url):
+    """Return the shared session for the host of some URL."""
+
+    host = host_of(url)
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = sessions.session(config={
+                'pool_connections': 1,
+                'pool_maxsize': POOL_MAXSIZE
+            })
+        return _sessions[host]
+
+def prewarm(urls, deadline=None):
+    """
+    Open a connection to the host of each URL ahead of time, so the first real
+    requests to them don't pay for connection setup. Errors are ignored.
+    """
+
+    map([head(url, deadline=deadline) for url in urls], deadline=deadline)
+
+def patched(f, url_index=0):
+    """
+    Patches a given API function to not send, and to use the shared session for
+    the host of the URL at position url_index of its arguments.
+    """
 
     def wrapped(*args, **kwargs):
 
+        # reuse connections to the same host
+        if 'session' not in kwargs:
+            if 'url' in kwargs:
+                url = kwargs['url']
+            elif len(args) > url_index:
+                url = args[url_index]
+            else:
+                raise TypeError("%s() needs a url" % f.__name__)
+            kwargs['session'] = session_for(url)
+
+        # turn an absolute deadline into a socket timeout
+        deadline = kwargs.pop('deadline', None)
+        if deadline is not None and kwargs.get('timeout') is None:
+            kwargs['timeout'] = timeout_for(deadline)
+
         kwargs['return_response'] = False
-        kwargs['prefetch'] = True
 
         config = kwargs.get('config', {})
         config.update(safe_mode=True)
@@ -42,21 +104,431 @@ post = patched(api.post)
 put = patched(api.put)
 patch = patched(api.patch)
 delete = patched(api.delete)
-request = patched(api.request)
+request = patched(api.request, url_index=1)
+
+def timeout_for(deadline, minimum=0.001):
+    """
+    Return the number of seconds left until an absolute time.time() deadline,
+    suitable for use as a request timeout. Returns None if deadline is None.
+    """
+
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), minimum)
+
+def failed(request, error):
+    """Build a ``Response`` for a request that errored, as safe mode does."""
+
+    response = models.Response()
+    response.request = request
+    response.url = request.url
+    response.error = error
+    response.raw = HTTPResponse()
+    response.status_code = 0
+    return response
+
+class HTTPCache(object):
+    """
+    Caches GET and HEAD responses according to their Cache-Control or Expires
+    headers, and revalidates stale ones with If-None-Match/If-Modified-Since
+    when they came with an ETag or Last-Modified header. Responses are keyed
+    by method, URL, and params, ignoring params that change on every signed
+    request without changing the response.
+    """
+
+    # params that differ between otherwise identical signed requests
+    VOLATILE_PARAMS = frozenset([
+        "Timestamp", "Signature", # amazon
+        "oauth_nonce", "oauth_timestamp", "oauth_signature" # netflix
+    ])
+
+    def __init__(self, max_entries=1024):
+        # maps keys to (response, time fresh until) tuples
+        self.entries = cache.LRUCache(max_entries)
+
+    @staticmethod
+    def key(request):
+        """Build the cache key for a request."""
+
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(request.url)
+
+        # combine params from the URL with those given separately
+        params = urlparse.parse_qsl(query, keep_blank_values=True)
+        extra = request.params or {}
+        if hasattr(extra, "items"):
+            extra = extra.items()
+        params.extend(extra)
+
+        # byte strings are left as they are, as requests sends them
+        params = sorted((HTTPCache.to_bytes(k), HTTPCache.to_bytes(v))
+                for k, v in params if k not in HTTPCache.VOLATILE_PARAMS)
+
+        return (request.method.upper(), scheme.lower(), netloc.lower(), path,
+                urllib.urlencode(params))
+
+    @staticmethod
+    def to_bytes(value):
+        """Encode unicode as UTF-8 and turn anything else into a str."""
+
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        return str(value)
+
+    @staticmethod
+    def freshness(response):
+        """
+        Return how many seconds a response may be used for without
+        revalidation, or None if it mustn't be stored at all.
+        """
+
+        cache_control = response.headers.get("cache-control") or ""
+        directives = [d.strip().lower() for d in cache_control.split(",")]
+
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return 0
+
+        for directive in directives:
+            match = re.match(r"(?:s-)?max-age\s*=\s*(\d+)$", directive)
+            if match is not None:
+                return int(match.group(1))
+
+        # fall back to the Expires header, relative to the server's clock
+        expires = HTTPCache.parse_date(response.headers.get("expires"))
+        if expires is not None:
+            date = HTTPCache.parse_date(response.headers.get("date"))
+            return max(expires - (date or time.time()), 0)
+
+        return 0
+
+    @staticmethod
+    def parse_date(value):
+        """Parse an HTTP date header into a timestamp, or None if invalid."""
+
+        if not value:
+            return None
+
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return email.utils.mktime_tz(parsed)
+
+    def send(self, request, transmit):
+        """
+        Return a response for the request, from the cache if possible and
+        otherwise by passing the request to transmit.
+        """
+
+        if request.method.upper() not in {"GET", "HEAD"}:
+            return transmit(request)
+
+        key = HTTPCache.key(request)
+        entry = self.entries.get(key)
+
+        # serve fresh responses without asking upstream at all
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        # ask upstream whether our stale copy is still good
+        if entry is not None:
+            etag = entry[0].headers.get("etag")
+            last_modified = entry[0].headers.get("last-modified")
+            if etag:
+                request.headers["If-None-Match"] = etag
+            if last_modified:
+                request.headers["If-Modified-Since"] = last_modified
+
+        response = transmit(request)
+
+        if entry is not None and response.status_code == 304:
+            self.store(key, entry[0], response)
+            return entry[0]
+
+        if response.status_code == 200:
+            self.store(key, response, response)
+        return response
+
+    def store(self, key, response, fresh_response):
+        """
+        Cache response under key for as long as fresh_response says it's good
+        for, if it can be used or revalidated at all.
+        """
+
+        fresh_for = HTTPCache.freshness(fresh_response)
+        if fresh_for is None:
+            self.entries.pop(key)
+            return
+
+        revalidatable = (response.headers.get("etag") or
+                response.headers.get("last-modified"))
+        if fresh_for > 0 or revalidatable:
+            self.entries.set(key, (response, time.time() + fresh_for))
+
+# the cache shared by everything that sends through this module, or None to
+# disable caching
+http_cache = HTTPCache()
+
+class Hedger(object):
+    """
+    Cuts tail latency for idempotent requests. Requests are sent from the
+    calling thread, and if one hasn't been answered within its host's recent
+    95th percentile latency, an identical one is queued on the shared pool.
+    Should the first fail, the second's answer is used instead of retrying
+    from scratch. No more than budget extra requests are sent per request
+    overall.
+    """
+
+    def __init__(self, budget=0.05, percentile=0.95, window=200,
+            min_samples=20):
+        self.budget = budget
+        self.percentile = percentile
+        self.min_samples = min_samples
+
+        # the most recent latencies seen for each host
+        self.__latencies = collections.defaultdict(
+                lambda: collections.deque(maxlen=window))
+
+        # how many requests we've been asked to send, how many hedges we've
+        # queued for them, and how many of those were used
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+        # queues the copies of slow requests
+        self.__scheduler = tmap.Scheduler()
+
+        self.__lock = threading.Lock()
+
+    def delay(self, host):
+        """
+        Return how long to wait before hedging a request to host, or None if
+        we haven't seen enough of its requests to know.
+        """
+
+        with self.__lock:
+            latencies = sorted(self.__latencies[host])
+        if len(latencies) < self.min_samples:
+            return None
+
+        return latencies[int(self.percentile * (len(latencies) - 1))]
+
+    def timed(self, host, transmit, request):
+        """Call transmit with request, recording how long host took."""
+
+        start = time.time()
+        response = transmit(request)
+        if response.status_code:
+            with self.__lock:
+                self.__latencies[host].append(time.time() - start)
+        return response
+
+    def send(self, request, transmit):
+        """Send a request with transmit, hedging it if it's slow to answer."""
+
+        host = host_of(request.url)
+        with self.__lock:
+            self.requests += 1
+
+        delay = self.delay(host)
+        if delay is None or request.method.upper() not in {"GET", "HEAD"}:
+            return self.timed(host, transmit, request)
+
+        # the copy is only queued once the request turns out to be slow, so
+        # most requests never take up a second thread
+        hedges = []
+        def hedge():
+            with self.__lock:
+                if self.hedges >= self.budget * self.requests:
+                    return
+                self.hedges += 1
+
+            hedges.append(tmap.shared_pool().submit(self.timed, host,
+                    transmit, clone(request)))
+
+        timer = self.__scheduler.call_later(delay, hedge)
+        response = self.timed(host, transmit, request)
+        if not timer.cancel():
+            timer.wait()
+
+        if not hedges:
+            return response
+
+        # the copy isn't needed if the request went well. otherwise, wait for
+        # it, sending it ourselves if no thread has picked it up yet.
+        if healthy(response):
+            hedges[0].cancel()
+            return response
+
+        hedged = hedges[0].join()
+        if not healthy(hedged):
+            return response
+
+        with self.__lock:
+            self.wins += 1
+        return hedged
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "wins": self.wins
+            }
+
+# hedges slow idempotent requests when set to a Hedger, or None not to
+hedger = None
+
+# limits on how often each host may be sent requests, shared by the process
+rate_limiter = throttle.RateLimiter()
+
+# limits on how many requests may be in flight to each host at once, which
+# adjust themselves to how well each host is coping
+concurrency_limiter = throttle.AdaptiveLimiter()
+
+def healthy(response):
+    """
+    Whether a response suggests its host is coping with our load. Timeouts,
+    connection errors, server errors, and throttling all suggest it isn't.
+    """
+
+    if response.error is not None or not response.status_code:
+        return False
+    return response.status_code < 500 and response.status_code != 429
+
+def transient(response):
+    """
+    Whether a failed response is worth retrying: connection errors and server
+    errors that may well not happen again. Timeouts aren't, since retrying
+    them would only make us later still.
+    """
+
+    if response.status_code == 0:
+        return not isinstance(response.error, exceptions.Timeout)
+    return response.status_code in {500, 502, 503, 504}
+
+# how many times idempotent requests are retried after transient failures,
+# and the base delay before a retry. the delay doubles with each attempt and
+# is jittered so retries from many threads don't arrive together.
+RETRIES = 2
+RETRY_DELAY = 0.1
+
+def transmit(request, prefetch=True, deadline=None):
+    """
+    Actually send a request over the network and return its response,
+    retrying idempotent requests that fail transiently for as long as the
+    deadline allows.
+    """
+
+    retries = RETRIES
+    if request.method.upper() not in {"GET", "HEAD", "OPTIONS"}:
+        retries = 0
+
+    for attempt in xrange(retries + 1):
+        response = transmit_once(request, prefetch, deadline)
+        if attempt == retries or not transient(response):
+            break
+
+        delay = random.uniform(0, RETRY_DELAY * 2 ** attempt)
+        if deadline is not None and time.time() + delay >= deadline:
+            break
+        time.sleep(delay)
+
+    return response
+
+def transmit_once(request, prefetch=True, deadline=None):
+    """
+    Send a request once, first waiting for its host's rate and concurrency
+    limits. If either wait would pass the deadline, a failed response is
+    returned instead.
+    """
+
+    host = host_of(request.url)
+    if not rate_limiter.acquire(host, deadline):
+        return failed(request, exceptions.Timeout("rate limited"))
+
+    limit = concurrency_limiter.get(host)
+    started = limit.acquire(deadline)
+    if started is None:
+        return failed(request, exceptions.Timeout("concurrency limited"))
+
+    # safe mode only applies within requests.api, so errors from a deferred
+    # send have to be turned into failed responses here. retries send the same
+    # request again, which requests only does when told to.
+    ok = False
+    try:
+        try:
+            request.send(anyway=True, prefetch=prefetch)
+        except exceptions.RequestException as e:
+            return failed(request, e)
+        ok = healthy(request.response)
+    finally:
+        limit.release(started, ok)
 
-def send(request, prefetch):
-    """Send a request and return its response."""
-    request.send(prefetch)
     return request.response
 
-def map(requests, prefetch=True, size=None):
+def clone(original):
+    """Build an unsent copy of a request."""
+
+    return request(original.method, original.url,
+            params=original.params,
+            headers=original.headers,
+            data=original.data,
+            timeout=original.timeout,
+            allow_redirects=original.allow_redirects,
+            session=original.session)
+
+def send(request, prefetch=True, deadline=None):
+    """
+    Send a request and return its response, using the HTTP cache and hedging
+    if they're enabled. If the deadline has already passed, the request isn't
+    sent and a failed response is returned instead.
+    """
+
+    if deadline is not None and time.time() >= deadline:
+        return failed(request, exceptions.Timeout("deadline passed"))
+
+    tf = lambda r: transmit(r, prefetch, deadline)
+    if hedger is not None:
+        tf = lambda r, tf=tf: hedger.send(r, tf)
+
+    # streamed bodies can't be cached, since they're only read once
+    if prefetch and http_cache is not None:
+        return http_cache.send(request, tf)
+
+    return tf(request)
+
+def map(requests, prefetch=True, size=None, pool=None, deadline=None):
     """Concurrently converts a list of Requests to Responses.
 
     :param requests: a collection of Request objects.
     :param prefetch: If False, the content will not be downloaded immediately.
     :param size: Specifies the number of requests to make at a time. If None, no throttling occurs.
+    :param pool: The ``tmap.Pool`` to send on. Defaults to the shared pool.
+    :param deadline: An absolute time.time() after which unsent requests are given failed responses.
     """
 
+    if pool is None:
+        pool = tmap.shared_pool()
+
     # send the requests in paralell and return the results
-    nt = size if size is not None else len(requests)
-    return tmap.map(lambda r: send(r, prefetch), requests, num_threads=nt)
+    sf = lambda r: send(r, prefetch, deadline)
+    return pool.map(sf, requests, limit=size)
+
+def imap(requests, prefetch=True, size=2, pool=None, deadline=None):
+    """Concurrently converts a generator object of Requests to
+    a generator of Responses, yielded in the order they arrive.
+
+    :param requests: a generator of Request objects.
+    :param prefetch: If False, the content will not be downloaded immediately.
+    :param size: Specifies the number of requests to make at a time. If None, no throttling occurs.
+    :param pool: The ``tmap.Pool`` to send on. Defaults to the shared pool.
+    :param deadline: An absolute time.time() after which unsent requests are given failed responses.
+    """
+
+    if pool is None:
+        pool = tmap.shared_pool()
+
+    sf = lambda r: send(r, prefetch, deadline)
+    for index, response in pool.imap_unordered(sf, requests, limit=size):
+        yield response
@@ -0,0 +1,83 @@
+import threading
+import time
+
+class CircuitBreaker(object):
+    """
+    Stops calls to something that keeps failing. After failure_threshold
+    failures in a row the breaker opens, and calls are refused outright. Once
+    reset_timeout seconds have passed, a single trial call is let through
+    (half-open): if it succeeds the breaker closes again, otherwise it
+    reopens for another reset_timeout.
+    """
+
+    CLOSED = u"closed"
+    OPEN = u"open"
+    HALF_OPEN = u"half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        assert failure_threshold > 0
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+
+        # when the breaker last opened, and how many calls it refused
+        self.opened = None
+        self.refusals = 0
+
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return whether a call may be made now. Every call that's allowed must
+        be followed by a call to success or failure.
+        """
+
+        with self.__lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            # let a single trial call through once we've waited long enough
+            if (self.state == CircuitBreaker.OPEN and
+                    time.time() - self.opened >= self.reset_timeout):
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+
+            self.refusals += 1
+            return False
+
+    def success(self):
+        with self.__lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = CircuitBreaker.OPEN
+                self.opened = time.time()
+
+    def inconclusive(self):
+        """
+        Record an allowed call that says nothing about whether the other side
+        is healthy, such as one we gave up on ourselves. A trial call that ends
+        this way lets the next call be the trial instead.
+        """
+
+        with self.__lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+
+    def stats(self):
+        """Return the breaker's state and counters as a dict."""
+
+        with self.__lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "refusals": self.refusals
+            }
@@ -0,0 +1,126 @@
+import collections
+import threading
+import time
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most max_entries items, evicting the
+    least recently used one when full. Entries may be given a time to live in
+    seconds, after which they're treated as missing. If max_bytes is given,
+    entries are also evicted to keep the total of their sizes under it.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # counters for how well the cache is working
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # maps keys to (value, expiration time, size) tuples, oldest use first
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if it's missing or expired."""
+
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or (entry[1] is not None and
+                    entry[1] <= time.time()):
+                if entry is not None:
+                    self.__bytes -= entry[2]
+                self.misses += 1
+                return default
+
+            # move the entry to the most recently used end
+            self.__entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None, size=0):
+        """
+        Store a value for key, optionally expiring after ttl seconds. size is
+        how many bytes the value takes up, for caches with a max_bytes.
+        """
+
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        with self.__lock:
+            self.__store(key, value, expires, size)
+
+    def __store(self, key, value, expires, size=0):
+        """Store an entry and evict old ones as needed. Must hold the lock."""
+
+        self.__remove(key)
+        self.__entries[key] = (value, expires, size)
+        self.__bytes += size
+
+        while len(self.__entries) > self.max_entries or (
+                self.max_bytes is not None and self.__bytes > self.max_bytes):
+            old_key, old_entry = self.__entries.popitem(last=False)
+            self.__bytes -= old_entry[2]
+            self.evictions += 1
+
+    def __remove(self, key):
+        """Remove key and return its entry, or None. Must hold the lock."""
+
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__bytes -= entry[2]
+        return entry
+
+    def dump(self):
+        """
+        Return a list of (key, value, expiration time) tuples for every entry
+        that hasn't expired, least recently used first. Expiration times are
+        absolute time.time() values, or None for entries that never expire.
+        """
+
+        now = time.time()
+        with self.__lock:
+            return [(key, value, expires)
+                    for key, (value, expires, size) in self.__entries.items()
+                    if expires is None or expires > now]
+
+    def load(self, entries):
+        """Store entries as returned by dump, skipping any that have expired."""
+
+        now = time.time()
+        with self.__lock:
+            for key, value, expires in entries:
+                if expires is None or expires > now:
+                    self.__store(key, value, expires)
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default if it wasn't there."""
+
+        with self.__lock:
+            entry = self.__remove(key)
+            return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def stats(self):
+        """Return the cache's counters and size as a dict."""
+
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def __len__(self):
+        return len(self.__entries)
@@ -9,6 +9,22 @@ class Suggestion:
     def to_dict(self):
         return dict(self.__dict__)
 
+class Results(list):
+    """
+    The combined results of a search across several providers, along with the
+    names of the providers that didn't answer in time, failed outright, or
+    were skipped because they've been failing, and the cursor for the next
+    page of results, if there is one.
+    """
+
+    def __init__(self, results=(), timed_out=None, failed=None, skipped=None,
+            cursor=None):
+        list.__init__(self, results)
+        self.timed_out = timed_out if timed_out is not None else []
+        self.failed = failed if failed is not None else []
+        self.skipped = skipped if skipped is not None else []
+        self.cursor = cursor
+
 class Result:
     """A basic search result."""
 
@@ -21,8 +37,10 @@ class Result:
         assert result_type in {Result.MOVIE, Result.EPISODE, Result.SERIES}
         self.type = result_type
 
-        # who the search result came from
+        # who the search result came from, and its id there. ids are only
+        # unique among results of the same provider and type.
         self.provider = provider
+        self.id = None
 
         self.title = None
         self.description = None
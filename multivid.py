@@ -1,26 +1,537 @@
-import itertools
+import atexit
+import json
+import os
+import random
+import threading
+import time
 
+from requests import exceptions
+
+import arequests
+import breaker
+import cache
+import containers
 import search
+import throttle
 import tmap
 
 # the canonical list of search plugins used to do all the searches
 SEARCHERS = [
     search.AmazonSearch(),
-    search.HuluSearch(),
+    search.HuluSearch(defer_images=True),
     search.NetflixSearch()
 ]
 
-def autocomplete(query):
+# a circuit breaker for each searcher, so one that keeps failing is skipped
+# instead of slowing down every search
+BREAKERS = dict((s.name, breaker.CircuitBreaker()) for s in SEARCHERS)
+
+# a tmap.ProcessPool to parse responses on, or None to parse them on the same
+# threads that fetched them
+PARSE_POOL = None
+
+# what each searcher returned for recent queries, bounded by both entry count
+# and size. cached results are shared between callers, so mustn't be modified.
+RESULT_CACHE = cache.LRUCache(4096, max_bytes=16 * 1024 * 1024)
+
+# how long, in seconds, to cache each searcher's results, by searcher name.
+# searchers without an entry use RESULT_TTL, and a TTL of 0 disables caching.
+# TTLs are shortened by up to RESULT_TTL_JITTER of themselves so that entries
+# cached together don't all expire together.
+RESULT_TTL = 60
+RESULT_TTLS = {}
+RESULT_TTL_JITTER = 0.1
+
+# how long, in seconds, results may still be served once their TTL is up.
+# serving stale results starts a refresh of them in the background.
+RESULT_GRACE = 300
+
+# how many background refreshes may be started, and how long each may take
+REFRESH_BUDGET = throttle.TokenBucket(2, burst=10)
+REFRESH_TIMEOUT = 10.0
+
+# the result keys being refreshed, so each is only refreshed once at a time,
+# and counters for what became of refreshes that were asked for
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_refresh_counts = {"started": 0, "coalesced": 0, "throttled": 0}
+
+def configure(config_file="multivid.conf"):
+    """
+    Apply the process-wide settings from the config file, if there is one.
+    Returns the parsed config.
+    """
+
+    global RESULT_CACHE, RESULT_TTL, RESULT_TTLS, RESULT_GRACE, REFRESH_BUDGET
+
+    if not os.path.exists(config_file):
+        return {}
+
+    with open(config_file, 'r') as cf:
+        config = json.load(cf)
+
+    # when to stop trying searchers that keep failing, and for how long
+    breakers = config.get("breakers", {})
+    for name in BREAKERS:
+        BREAKERS[name] = breaker.CircuitBreaker(
+                breakers.get("failure_threshold", 5),
+                breakers.get("reset_timeout", 30.0))
+
+    # whether Amazon's later pages are only fetched when the first is full,
+    # and whether its results get descriptions and ratings looked up
+    amazon = config.get("amazon", {})
+    for searcher in SEARCHERS:
+        if isinstance(searcher, search.AmazonSearch):
+            searcher.adaptive_pages = bool(amazon.get("adaptive_pages",
+                    searcher.adaptive_pages))
+            searcher.enrich = bool(amazon.get("enrich", searcher.enrich))
+
+    # whether searches wait for better Hulu images or leave them for later
+    hulu = config.get("hulu", {})
+    if "defer_images" in hulu:
+        for searcher in SEARCHERS:
+            if isinstance(searcher, search.HuluSearch):
+                searcher.defer_images = bool(hulu["defer_images"])
+
+    # how long and how many of each searcher's results to keep. bounds that
+    # aren't given keep their current values.
+    results = config.get("result_cache", {})
+    if "max_entries" in results or "max_bytes" in results:
+        RESULT_CACHE = cache.LRUCache(
+                results.get("max_entries", RESULT_CACHE.max_entries),
+                max_bytes=results.get("max_bytes", RESULT_CACHE.max_bytes))
+    RESULT_TTL = results.get("ttl", RESULT_TTL)
+    RESULT_TTLS = results.get("ttls", RESULT_TTLS)
+
+    # how long stale results may be served, and how often they're refreshed
+    RESULT_GRACE = results.get("grace", RESULT_GRACE)
+    if "refresh_rate" in results:
+        REFRESH_BUDGET = throttle.TokenBucket(results["refresh_rate"],
+                results.get("refresh_burst", 1))
+
+    # keep what we know about Hulu's images across restarts
+    image_cache_file = hulu.get("image_cache_file")
+    if image_cache_file:
+        search.HuluSearch.load_image_cache(image_cache_file)
+        atexit.register(search.HuluSearch.save_image_cache, image_cache_file)
+
+    # connection pooling for upstream hosts
+    http = config.get("http", {})
+    if "pool_maxsize" in http:
+        arequests.POOL_MAXSIZE = int(http["pool_maxsize"])
+
+    # caching of upstream responses, disabled if the size is 0
+    if "cache_entries" in http:
+        entries = int(http["cache_entries"])
+        arequests.http_cache = None
+        if entries > 0:
+            arequests.http_cache = arequests.HTTPCache(entries)
+
+    # how often each upstream host may be sent requests
+    for host, limit in http.get("rate_limits", {}).items():
+        arequests.rate_limiter.limit(host.lower(), limit["rate"],
+                limit.get("burst", 1))
+
+    # sending a second copy of slow requests, capped at a fraction of requests
+    if "hedge_budget" in http:
+        arequests.hedger = None
+        if http["hedge_budget"] > 0:
+            arequests.hedger = arequests.Hedger(http["hedge_budget"])
+
+    # bounds on how many requests may be in flight to any one host
+    if "concurrency" in http:
+        arequests.concurrency_limiter = throttle.AdaptiveLimiter(
+                **dict((str(k), v) for k, v in http["concurrency"].items()))
+
+    return config
+
+def prewarm(budget_ms=None):
+    """Open connections to every host the searchers talk to."""
+
+    urls = [url for s in SEARCHERS for url in s.urls()]
+    arequests.prewarm(urls, deadline=deadline_for(budget_ms))
+
+def stats():
+    """Return counters describing the process's upstream traffic."""
+
+    http_cache = arequests.http_cache
+    return {
+        "http_cache": http_cache.entries.stats() if http_cache else None,
+        "result_cache": RESULT_CACHE.stats(),
+        "result_refreshes": dict(_refresh_counts),
+        "image_cache": search.HuluSearch.image_cache.stats(),
+        "detail_caches": {
+            "amazon": search.AmazonSearch.detail_cache.stats(),
+            "netflix": search.NetflixSearch.detail_cache.stats()
+        },
+        "rate_limits": arequests.rate_limiter.stats(),
+        "concurrency_limits": arequests.concurrency_limiter.stats(),
+        "breakers": dict((n, b.stats()) for n, b in BREAKERS.items()),
+        "hedging": arequests.hedger.stats() if arequests.hedger else None
+    }
+
+def deadline_for(budget_ms):
+    """Turn a budget in milliseconds into an absolute deadline, or None."""
+
+    if budget_ms is None:
+        return None
+    return time.time() + budget_ms / 1000.0
+
+def parse(searcher_payloads):
+    """Parse a (searcher, payloads) tuple. Module-level so it can be pickled."""
+
+    searcher, payloads = searcher_payloads
+    return searcher.parse(payloads)
+
+def complete(searcher, payloads, query=None, deadline=None, position=None,
+        limit=None):
+    """
+    Parse and finish a searcher's fetched payloads for a query, parsing on
+    PARSE_POOL if one has been set up.
+    """
+
+    if PARSE_POOL is None:
+        results = searcher.parse(payloads)
+    else:
+        results = PARSE_POOL.map(parse, [(searcher, payloads)])[0]
+
+    return searcher.finish(results, query=query, deadline=deadline,
+            position=position, limit=limit)
+
+def find_one(searcher, query, deadline=None, position=None, limit=None):
+    """Fetch and complete a single searcher's results for a query."""
+
+    payloads = searcher.fetch(query, deadline=deadline, position=position,
+            limit=limit)
+    return complete(searcher, payloads, query=query, deadline=deadline,
+            position=position, limit=limit)
+
+def complete_sent(sent, searcher, **kwargs):
+    """Complete a searcher given the Outcomes of sending its requests."""
+
+    payloads = search.Search.payloads([o.get() for o in sent])
+    return complete(searcher, payloads, **kwargs)
+
+def autocomplete(query, budget_ms=None):
+    query = text(query)
+    deadline = deadline_for(budget_ms)
+
     # the query function we'll map onto the searchers
-    qf = lambda s: s.autocomplete(query)
+    qf = lambda s: s.autocomplete(query, deadline=deadline)
+
+    # searchers that were asked the same thing recently aren't asked again
+    keys = [result_key("autocomplete", s, query) for s in SEARCHERS]
+    cached = [cached_results(s, key, s.autocomplete, query)
+            for s, key in zip(SEARCHERS, keys)]
+
+    # get the results from the rest of the searchers. suggestions are needed
+    # on every keystroke, so they jump ahead of any other queued work.
+    allowed = [c is None and BREAKERS[s.name].allow()
+            for s, c in zip(SEARCHERS, cached)]
+    with tmap.scheduling(tmap.INTERACTIVE):
+        ran = iter(tmap.shared_pool().map_outcomes(qf,
+                [s for s, a in zip(SEARCHERS, allowed) if a],
+                deadline=deadline))
+
+    # searchers whose breakers are open are skipped
+    outcomes = []
+    for c, a in zip(cached, allowed):
+        if c is not None:
+            outcomes.append(tmap.Outcome(c))
+        elif a:
+            outcomes.append(ran.next())
+        else:
+            outcomes.append(tmap.Outcome(cancelled=True))
 
-    # get the results from the searchers
-    searcher_results = tmap.map(qf, SEARCHERS, num_threads=len(SEARCHERS))
+    settle([(s, key, o) for s, key, o, c
+            in zip(SEARCHERS, keys, outcomes, cached) if c is None])
 
     # return the results as one list
-    return [r for r in itertools.chain(*searcher_results)]
+    return merge(outcomes, SEARCHERS)
+
+def find(query, budget_ms=None, cursor=None, limit=None):
+    """
+    Search every provider for a query, a page at a time. limit is roughly how
+    many results to ask each provider for. The returned Results' cursor may be
+    passed back in to get the next page, which only asks the providers that
+    may have more. Raises ValueError if the cursor is malformed.
+    """
+
+    query = text(query)
+    deadline = deadline_for(budget_ms)
+
+    positions = positions_for(cursor)
+    searchers = [s for s in SEARCHERS if s.name in positions]
+
+    with tmap.scheduling(tmap.NORMAL):
+        pool = tmap.shared_pool()
+        sf = lambda r: arequests.send(r, True, deadline)
+
+        # send every searcher's requests at once, rather than having each
+        # searcher wait on its own from its own thread. each searcher's
+        # responses are parsed as soon as the last of them comes back.
+        outcomes = []
+        asked = []
+        tasks = []
+        for searcher in searchers:
+            position = positions[searcher.name]
+
+            # searchers that were asked the same thing recently aren't asked
+            # again
+            key = result_key("find", searcher, query, position, limit)
+            cached = cached_results(searcher, key, find_one, searcher, query,
+                    position=position, limit=limit)
+            if cached is not None:
+                outcomes.append(tmap.Outcome(cached))
+                continue
+
+            # searchers whose breakers are open are skipped
+            if not BREAKERS[searcher.name].allow():
+                outcomes.append(tmap.Outcome(cancelled=True))
+                asked.append((searcher, key, len(outcomes) - 1))
+                continue
+
+            built = tmap.Outcome.of(searcher.build_requests, query,
+                    deadline=deadline, position=position, limit=limit)
+            asked.append((searcher, key, len(outcomes)))
+            if not built.ok:
+                outcomes.append(built)
+                continue
+
+            # the outcome is filled in once the searcher has finished
+            outcomes.append(None)
+            sent = [pool.submit(sf, r) for r in built.value]
+            tasks.append(pool.submit_after(sent, complete_sent, searcher,
+                    query=query, deadline=deadline, position=position,
+                    limit=limit))
+
+        # fill in the outcomes of the searchers whose requests got sent
+        completed = iter(tmap.outcomes(tasks, deadline=deadline))
+        outcomes = [completed.next() if o is None else o for o in outcomes]
+
+    settle([(s, k, outcomes[i]) for s, k, i in asked])
+
+    results = merge(outcomes, searchers)
+    results.cursor = next_cursor(outcomes, searchers, positions, limit)
+    return results
+
+def positions_for(cursor):
+    """
+    Return a dict mapping the name of each searcher a cursor from find still
+    has results for to the position it should start at. With no cursor, every
+    searcher starts at the beginning. Raises ValueError if the cursor is
+    malformed or holds a position its searcher couldn't have made.
+    """
+
+    if cursor is None:
+        return dict((s.name, None) for s in SEARCHERS)
+
+    # searchers missing from a cursor have run out of results
+    positions = search.Search.decode_cursor(cursor)
+
+    # cursors come from clients, so each searcher checks its own position
+    for searcher in SEARCHERS:
+        if searcher.name in positions:
+            positions[searcher.name] = searcher.check_position(
+                    positions[searcher.name])
+
+    return positions
+
+def next_cursor(outcomes, searchers, positions, limit=None):
+    """
+    Build the cursor for the page after the one the outcomes came from, or
+    return None if every searcher has run out. Searchers that didn't answer
+    are asked for the same page again.
+    """
+
+    next_positions = {}
+    for searcher, outcome in zip(searchers, outcomes):
+        position = positions[searcher.name]
+        if outcome.ok:
+            position = searcher.next_position(outcome.value,
+                    position=position, limit=limit)
+            if position is None:
+                continue
+
+        next_positions[searcher.name] = position
+
+    if not next_positions:
+        return None
+    return search.Search.encode_cursor(next_positions)
+
+def images(image_urls, budget_ms=None):
+    """
+    Return a dict mapping image URLs from earlier results to the best versions
+    of them that could be found within the budget. Images that can't be
+    improved, or weren't found in time, map to themselves.
+    """
+
+    deadline = deadline_for(budget_ms)
+
+    best = dict((url, url) for url in image_urls)
+    for searcher in SEARCHERS:
+        if isinstance(searcher, search.HuluSearch):
+            best.update(searcher.get_known_image_urls(image_urls,
+                    deadline=deadline))
+
+    return best
+
+def text(query):
+    """
+    Return a query as unicode. Byte strings, like the ones bottle gives us,
+    are decoded as UTF-8, with anything undecodable replaced.
+    """
+
+    if isinstance(query, str):
+        return query.decode("utf-8", "replace")
+    return query
+
+def result_key(kind, searcher, query, position=None, limit=None):
+    """
+    Return the RESULT_CACHE key for what a searcher returns for some kind of
+    call. Queries that only differ in case or spacing share a key.
+    """
+
+    if isinstance(query, basestring):
+        query = u" ".join(query.lower().split())
+
+    return (kind, searcher.name, query, json.dumps(position, sort_keys=True),
+            limit)
+
+def settle(asked):
+    """
+    Given (searcher, result key, outcome) tuples for the searchers that were
+    just asked for results, tell their breakers how they did and cache the
+    results of those that succeeded.
+    """
+
+    record([o for s, key, o in asked], [s for s, key, o in asked])
+
+    for searcher, key, outcome in asked:
+        ttl = RESULT_TTLS.get(searcher.name, RESULT_TTL)
+        if outcome.ok and ttl > 0:
+            ttl *= 1 - RESULT_TTL_JITTER * random.random()
+            size = sum(len(json.dumps(r.to_dict())) for r in outcome.value)
+
+            # entries are kept through their grace period, but remember when
+            # they went stale
+            RESULT_CACHE.set(key, (outcome.value, time.time() + ttl),
+                    ttl=ttl + RESULT_GRACE, size=size)
+
+def cached_results(searcher, key, function, *args, **kwargs):
+    """
+    Return a searcher's cached results for key, or None if there aren't any.
+    If the results are stale, they're refreshed in the background by calling
+    function with args, kwargs, and a deadline.
+    """
+
+    entry = RESULT_CACHE.get(key)
+    if entry is None:
+        return None
+
+    results, stale_at = entry
+    if time.time() >= stale_at:
+        refresh(searcher, key, function, *args, **kwargs)
+
+    return results
+
+def refresh(searcher, key, function, *args, **kwargs):
+    """
+    Replace a searcher's results for key in the background, with the results
+    of calling function with args, kwargs, and a deadline. Keys that are
+    already being refreshed aren't refreshed again, and refreshes beyond the
+    refresh budget are skipped, leaving the stale results to be served until
+    they expire.
+    """
+
+    with _refreshing_lock:
+        if key in _refreshing:
+            _refresh_counts["coalesced"] += 1
+            return
+
+        if not REFRESH_BUDGET.take():
+            _refresh_counts["throttled"] += 1
+            return
+
+        _refreshing.add(key)
+        _refresh_counts["started"] += 1
+
+    def run():
+        try:
+            # searchers that keep failing aren't refreshed either
+            if BREAKERS[searcher.name].allow():
+                kwargs["deadline"] = time.time() + REFRESH_TIMEOUT
+                settle([(searcher, key,
+                        tmap.Outcome.of(function, *args, **kwargs))])
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    # refreshes are only needed for the next caller, so they wait behind
+    # everything else
+    with tmap.scheduling(tmap.BACKGROUND):
+        tmap.shared_pool().submit(run)
+
+def record(outcomes, searchers=SEARCHERS):
+    """
+    Tell each searcher's breaker how its call went, unless it was skipped.
+    Calls that ran out of time say nothing about the searcher's upstream,
+    since the deadline is ours (and comes from the client), so they don't
+    count as failures.
+    """
+
+    for searcher, outcome in zip(searchers, outcomes):
+        if outcome.cancelled:
+            continue
+
+        if outcome.ok:
+            BREAKERS[searcher.name].success()
+        elif timed_out(outcome) or not upstream_failed(outcome):
+            BREAKERS[searcher.name].inconclusive()
+        else:
+            BREAKERS[searcher.name].failure()
+
+def upstream_failed(outcome):
+    """
+    Return whether a failed outcome was the upstream's fault: a connection
+    error, a server error or throttling, or a response that couldn't be
+    parsed. Other error statuses are taken to be about the request.
+    """
+
+    error = outcome.exception
+    if isinstance(error, exceptions.HTTPError):
+        response = getattr(error, "response", None)
+        if response is not None and response.status_code:
+            return (response.status_code >= 500 or
+                    response.status_code == 429)
+
+    return True
+
+def merge(outcomes, searchers=SEARCHERS):
+    """
+    Combine the searchers' outcomes into one list of results. Searchers that
+    raised, ran out of time, or were skipped contribute nothing rather than
+    failing the whole search, and are noted in the returned Results.
+    """
+
+    results = containers.Results()
+    for searcher, outcome in zip(searchers, outcomes):
+        if outcome.ok:
+            results.extend(outcome.value)
+        elif timed_out(outcome):
+            results.timed_out.append(searcher.name)
+        elif outcome.cancelled:
+            results.skipped.append(searcher.name)
+        else:
+            results.failed.append(searcher.name)
+
+    return results
+
+def timed_out(outcome):
+    """
+    Return whether an outcome ran out of time, either by still running at its
+    deadline or by having its requests given up on or time out.
+    """
 
-def find(query):
-    qf = lambda s: s.find(query)
-    searcher_results = tmap.map(qf, SEARCHERS, num_threads=len(SEARCHERS))
-    return [r for r in itertools.chain(*searcher_results)]
+    return outcome.timed_out or isinstance(outcome.exception,
+            exceptions.Timeout)
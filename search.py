@@ -1,22 +1,44 @@
 import base64
 import hashlib
 import hmac
+import io
 import json
 import os
 import random
 import string
+import threading
 import time
 import urllib
+import urlparse
+import xml.etree.cElementTree as ElementTree
 
 import bs4
-import requests
 
 import arequests
+import cache
 import containers
+import tmap
 
 class Search(object):
     """Base class for search plugins."""
 
+    # extra details looked up for results by id, for searchers that look them
+    # up with get_details. each such searcher needs its own.
+    detail_cache = None
+
+    # how long, in seconds, to keep details, and how many results to look up
+    # in a single request
+    DETAIL_CACHE_TTL = 24 * 60 * 60
+    DETAIL_BATCH_SIZE = 10
+
+    # details are nice to have, so looking them up may only take this share of
+    # the time left before a search's deadline, and is skipped altogether if
+    # less than DETAIL_MIN_SECONDS is left. with no deadline, they may take
+    # DETAIL_TIMEOUT seconds.
+    DETAIL_BUDGET_SHARE = 0.5
+    DETAIL_MIN_SECONDS = 0.1
+    DETAIL_TIMEOUT = 2.0
+
     def __init__(self, name=None, config_file="multivid.conf"):
         # set the config file if one is needed/was specified
         self.config_file = None
@@ -33,23 +55,314 @@ class Search(object):
         # the simple name of this search plugin, in lowercase
         self.name = unicode(name.lower())
 
-    def find(self, query):
+    def find(self, query, deadline=None, cursor=None, limit=None):
         """
         Synchonously run a search for some query and return the list of results.
-        If no results are found, should return an empty list.
+        If no results are found, should return an empty list. If a deadline (an
+        absolute time.time() value) is given, no request should be allowed to
+        outlive it.
+
+        Results come back a page at a time. limit is roughly how many results
+        to ask for, or None for the searcher's default. The returned list is a
+        containers.Results whose cursor, if it isn't None, can be passed back
+        in to get the next page.
+        """
+
+        position = None
+        if cursor is not None:
+            position = self.check_position(Search.decode_cursor(cursor))
+
+        payloads = self.fetch(query, deadline=deadline, position=position,
+                limit=limit)
+        results = self.finish(self.parse(payloads), query=query,
+                deadline=deadline, position=position, limit=limit)
+
+        next_position = self.next_position(results, position=position,
+                limit=limit)
+        return containers.Results(results,
+                cursor=Search.encode_cursor(next_position))
+
+    def fetch(self, query, deadline=None, position=None, limit=None):
+        """
+        Do the network half of a search and return the list of raw response
+        bodies that parse needs. This runs on a thread, since it mostly waits.
         """
 
-        raise NotImplemented("find must be implemented!")
+        requests = self.build_requests(query, deadline=deadline,
+                position=position, limit=limit)
+        responses = arequests.map(requests, deadline=deadline)
+        return Search.payloads(responses)
 
-    def autocomplete(self, query):
+    def build_requests(self, query, deadline=None, position=None, limit=None):
+        """
+        Build, but don't send, the list of requests a search needs. Keeping
+        this separate lets the requests of many searchers be sent together.
+        position is where in the results to start, as returned by
+        next_position, or None to start at the beginning.
+        """
+
+        raise NotImplementedError("build_requests must be implemented!")
+
+    def next_position(self, results, position=None, limit=None):
+        """
+        Return where the page after the one that produced results starts, as a
+        JSON-serializable dict, or None if there are no more results. By
+        default, searchers only have one page.
+        """
+
+        return None
+
+    @staticmethod
+    def encode_cursor(position):
+        """Turn a position into an opaque cursor string, or None into None."""
+
+        if position is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(position, sort_keys=True))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Turn a cursor made by encode_cursor back into a position. Raises
+        ValueError if the cursor is malformed.
+        """
+
+        try:
+            position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, UnicodeEncodeError):
+            raise ValueError("malformed cursor: %r" % cursor)
+
+        if not isinstance(position, dict):
+            raise ValueError("malformed cursor: %r" % cursor)
+        return position
+
+    def check_position(self, position):
+        """
+        Return a position taken from a cursor if it's one this searcher could
+        have made, raising ValueError if it isn't. Cursors come from clients,
+        so searchers whose positions hold values must check them here.
+        """
+
+        if position is not None and not isinstance(position, dict):
+            raise ValueError("malformed position: %r" % (position,))
+        return position
+
+    @staticmethod
+    def position_int(position, key, minimum, maximum=None):
+        """
+        Get an integer from a position, raising ValueError if it's missing or
+        outside of minimum to maximum, inclusive.
+        """
+
+        value = position.get(key)
+        if (not isinstance(value, (int, long)) or isinstance(value, bool) or
+                value < minimum or (maximum is not None and value > maximum)):
+            raise ValueError("bad %r in position: %r" % (key, position))
+        return value
+
+    @staticmethod
+    def payloads(responses):
+        """
+        Get the bodies of some responses. Raises the error of the first one
+        that failed or came back with an error status, since its body isn't
+        something parse can handle.
+        """
+
+        for r in responses:
+            r.raise_for_status()
+
+        return [r.content or "" for r in responses]
+
+    def parse(self, payloads):
+        """
+        Turn the bodies returned by fetch into a list of results. This must do
+        no I/O and the searcher must be picklable, so that parsing can be run
+        in another process.
+        """
+
+        raise NotImplementedError("parse must be implemented!")
+
+    @staticmethod
+    def iter_xml(payload, container, record):
+        """
+        Parse an XML payload incrementally, yielding each record element that's
+        a direct child of the first container element as soon as it's complete.
+        Namespaces are stripped from tags. Elements are thrown away once
+        they've been yielded, so memory use doesn't grow with the size of the
+        payload. Raises ElementTree.ParseError if the payload is malformed, and
+        ValueError if it has no container element, as error responses don't.
+        """
+
+        if isinstance(payload, unicode):
+            payload = payload.encode("utf-8")
+
+        parent = None
+        parent_depth = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(io.BytesIO(payload),
+                events=("start", "end")):
+            if event == "start":
+                depth += 1
+
+                # '{namespace}Tag' becomes 'Tag'
+                if elem.tag.startswith("{"):
+                    elem.tag = elem.tag.split("}", 1)[1]
+
+                if parent is None and elem.tag == container:
+                    parent = elem
+                    parent_depth = depth
+
+                continue
+
+            depth -= 1
+
+            # nothing after the first container matters
+            if elem is parent:
+                return
+
+            # yield records, dropping them and anything else that's done once
+            # they're outside of any record
+            if parent is not None and depth == parent_depth:
+                if elem.tag == record:
+                    yield elem
+                parent.remove(elem)
+            elif parent is None or depth < parent_depth:
+                elem.clear()
+
+        if parent is None:
+            raise ValueError("no <%s> element in payload" % container)
+
+    @staticmethod
+    def xml_find(elem, *tags):
+        """
+        Follow a chain of tags from elem, each step finding the first descendant
+        with the tag like BeautifulSoup's find does. Returns None if any step
+        finds nothing.
+        """
+
+        for tag in tags:
+            elem = next((e for e in elem.iter(tag) if e is not elem), None)
+            if elem is None:
+                return None
+
+        return elem
+
+    @staticmethod
+    def xml_text(elem, *tags):
+        """Return the text of the element xml_find finds, as unicode."""
+
+        return unicode(Search.xml_find(elem, *tags).text or u"")
+
+    def finish(self, results, query=None, deadline=None, position=None,
+            limit=None):
+        """
+        Do any network work the parsed results of a query still need, returning
+        the final list. By default, the results are returned unchanged.
+        """
+
+        return results
+
+    def fill_details(self, results, deadline=None):
+        """
+        Fill in the fields of some results that get_details finds and the
+        results don't already have. This is best-effort: results whose details
+        can't be found in time are left as they are.
+        """
+
+        if len(results) == 0:
+            return
+
+        # don't let the lookups use up the time the search has left
+        now = time.time()
+        if deadline is None:
+            deadline = now + self.DETAIL_TIMEOUT
+        elif deadline - now < self.DETAIL_MIN_SECONDS:
+            return
+        else:
+            deadline = now + (deadline - now) * self.DETAIL_BUDGET_SHARE
+
+        details = self.get_details([r.id for r in results], deadline=deadline)
+        for r in results:
+            for field, value in details.get(r.id, {}).items():
+                if getattr(r, field, None) is None:
+                    setattr(r, field, value)
+
+    def get_details(self, ids, deadline=None):
+        """
+        Look up extra details for results by id, returning a dict mapping ids
+        to dicts of the result fields found for them. Results looked up
+        recently are answered from the detail cache, and the rest are looked
+        up DETAIL_BATCH_SIZE at a time, with every batch sent at once. Results
+        whose batches failed are left out.
+        """
+
+        details = {}
+        missing = []
+        for result_id in ids:
+            cached = self.detail_cache.get(result_id)
+            if cached is not None:
+                details[result_id] = cached
+            elif result_id not in missing:
+                missing.append(result_id)
+
+        if len(missing) == 0:
+            return details
+
+        size = self.DETAIL_BATCH_SIZE
+        batches = [missing[i:i + size] for i in xrange(0, len(missing), size)]
+        requests = [self.build_details_request(batch, deadline=deadline)
+                for batch in batches]
+        responses = arequests.map(requests, deadline=deadline)
+
+        for batch, response in zip(batches, responses):
+            # batches that failed are left to be looked up next time
+            if not response.ok:
+                continue
+            try:
+                found = self.parse_details(response.content)
+            except (ValueError, ElementTree.ParseError):
+                continue
+
+            # results the batch didn't return have no details to find, so
+            # they're cached too rather than being asked about every time
+            for result_id in batch:
+                fields = found.get(result_id, {})
+                self.detail_cache.set(result_id, fields,
+                        ttl=self.DETAIL_CACHE_TTL)
+                details[result_id] = fields
+
+        return details
+
+    def build_details_request(self, ids, deadline=None):
+        """Build, but don't send, the request for a batch of details."""
+
+        raise NotImplementedError("build_details_request must be implemented!")
+
+    def parse_details(self, payload):
+        """
+        Turn the body of a details response into a dict mapping ids to dicts of
+        result fields. Raises ValueError if the body is malformed.
+        """
+
+        raise NotImplementedError("parse_details must be implemented!")
+
+    def autocomplete(self, query, deadline=None):
         """
         Get the list of lowercase autocomplete suggestions from the autocomplete
         search for some query, partial or otherwise. If no suggestions are
-        found, should return an empty list.
+        found, should return an empty list. Deadlines work as they do for find.
         """
 
         raise NotImplemented("autocomplete must be implemented!")
 
+    def urls(self):
+        """
+        Return a URL on every host this searcher talks to, for warming up
+        connections ahead of time.
+        """
+
+        return [self.search_url, self.autocomplete_url]
+
     @property
     def config(self):
         """Return the JSON config file contents."""
@@ -83,7 +396,29 @@ class Search(object):
         return config
 
 class HuluSearch(Search):
-    def __init__(self):
+    # the best image URL found for each thumbnail URL, shared by all instances.
+    # an entry that maps to itself means no better image exists.
+    image_cache = cache.LRUCache(20000)
+
+    # how long, in seconds, to trust what we found out about an image
+    IMAGE_CACHE_TTL = 7 * 24 * 60 * 60
+
+    # how long, in seconds, a background image lookup may take
+    IMAGE_LOOKUP_TIMEOUT = 10.0
+
+    # the hosts images may be looked up on, so we only probe our own
+    IMAGE_HOSTS = ("hulu.com", "huluim.com")
+
+    # the background lookups in progress, by original URL, so each image is
+    # only looked up once at a time
+    pending_images = {}
+    pending_images_lock = threading.Lock()
+
+    def __init__(self, defer_images=False):
+        # whether find leaves thumbnails alone and looks up better images in
+        # the background, rather than waiting for them
+        self.defer_images = defer_images
+
         # URLs we request data from
         self.search_url = "http://m.hulu.com/search"
         self.autocomplete_url = "http://www.hulu.com/search/suggest_json"
@@ -91,73 +426,378 @@ class HuluSearch(Search):
         # the maximum rating a video may receive
         self.rating_max = 5.0
 
+        # how many videos of each type to ask for when no limit is given, and
+        # the most that may be asked for at once
+        self.page_size = 20
+        self.max_page_size = 50
+
+        # where show art and thumbnails are served from
+        self.image_host_url = "http://ib.huluim.com/"
+
         Search.__init__(self, config_file=None)
 
+    def urls(self):
+        return Search.urls(self) + [self.image_host_url]
+
     @staticmethod
-    def get_best_image_url(orig_image_url):
+    def get_best_image_url(orig_image_url, deadline=None):
         """
         Attempts to look up a better image for the given URL using HTTP HEAD
         requests and known common image sizes. If one is found, returns the best
         one available, otherwise returns the original URL.
         """
 
+        return HuluSearch.get_best_image_urls([orig_image_url],
+                deadline=deadline)[orig_image_url]
+
+    @staticmethod
+    def get_best_image_urls(orig_image_urls, deadline=None, concurrency=8):
+        """
+        Like get_best_image_url, but for many images at once. Images that were
+        looked up recently are answered from the image cache, and the HEAD
+        requests for the rest are sent as one batch, no more than concurrency
+        at a time. Returns a dict mapping each original URL to the best URL
+        found for it.
+        """
+
         # the default size returned
         orig_size = "145x80"
 
-        # better common sizes
-        better_size = "384x288"
-        best_size = "512x288"
+        # better common sizes, in increasing order of preference
+        better_sizes = ("384x288", "512x288")
+
+        # start out with what we already know, or the original URLs if nothing
+        best = {}
+        for url in orig_image_urls:
+            cached = HuluSearch.image_cache.get(url)
+            best[url] = (cached, len(better_sizes)) if cached else (url, 0)
+
+        # every better URL we still need to check, along with the URL it
+        # replaces and how good it is, in the same order as their requests
+        candidates = []
+        img_reqs = []
+        looked_up = []
+        for orig_image_url, (url, rank) in best.items():
+            if rank > 0:
+                continue
+            looked_up.append(orig_image_url)
+
+            for rank, size in enumerate(better_sizes, 1):
+                img_url = orig_image_url.replace(orig_size, size)
+                if img_url != orig_image_url:
+                    candidates.append((img_url, orig_image_url, rank))
+                    img_reqs.append(arequests.head(img_url, deadline=deadline))
+
+        # upgrade the URLs as responses come back, noting any we couldn't check.
+        # responses are matched to their candidates by position rather than by
+        # URL, since requests re-quotes URLs and cached responses keep the URL
+        # of whichever request got them.
+        unchecked = set()
+        sf = lambda r: arequests.send(r, deadline=deadline)
+        for index, response in tmap.shared_pool().imap_unordered(sf, img_reqs,
+                limit=concurrency):
+            img_url, orig_image_url, rank = candidates[index]
+            if response.ok:
+                if rank > best[orig_image_url][1]:
+                    best[orig_image_url] = (img_url, rank)
+            elif not response.status_code:
+                unchecked.add(orig_image_url)
+
+        # remember what we found, unless a failure means we might be wrong
+        for orig_image_url in looked_up:
+            url, rank = best[orig_image_url]
+            if orig_image_url not in unchecked or rank == len(better_sizes):
+                HuluSearch.image_cache.set(orig_image_url, url,
+                        ttl=HuluSearch.IMAGE_CACHE_TTL)
+
+        return dict((orig, url) for orig, (url, rank) in best.items())
+
+    @staticmethod
+    def resolve_image_urls(orig_image_urls):
+        """
+        Start looking up the best images for some URLs in the background,
+        filling the image cache. URLs that are cached or already being looked
+        up are left alone. Returns a dict mapping each URL that's still being
+        looked up to the Task doing it, whose value will be the dict returned
+        by get_best_image_urls.
+        """
+
+        pending = HuluSearch.pending_images
+        with HuluSearch.pending_images_lock:
+            missing = [url for url in set(orig_image_urls)
+                    if url not in pending and
+                    HuluSearch.image_cache.get(url) is None]
 
-        # build the better URLs
-        better_img_url = orig_image_url.replace(orig_size, better_size)
-        best_img_url = orig_image_url.replace(orig_size, better_size)
+            task = None
+            if len(missing) > 0:
+                deadline = time.time() + HuluSearch.IMAGE_LOOKUP_TIMEOUT
+                with tmap.scheduling(tmap.BACKGROUND):
+                    task = tmap.shared_pool().submit(
+                            HuluSearch.get_best_image_urls, missing,
+                            deadline=deadline)
 
-        # build the better HEAD requests
-        better_img_req = arequests.head(better_img_url)
-        best_img_req = arequests.head(best_img_url)
+                for url in missing:
+                    pending[url] = task
 
-        # try to return the best image URL possible
-        best_url = orig_image_url
-        for response in arequests.map((better_img_req, best_img_req)):
-            if response.ok:
-                best_url = response.url
+            waiting = dict((url, pending[url])
+                    for url in orig_image_urls if url in pending)
+
+        # forget the lookup once it's done. this is done outside the lock
+        # since the task may already have finished and call us right away.
+        def finished(t):
+            with HuluSearch.pending_images_lock:
+                for url in missing:
+                    if pending.get(url) is t:
+                        del pending[url]
+
+        if task is not None:
+            task.add_done_callback(finished)
+
+        return waiting
+
+    @staticmethod
+    def is_own_image(url):
+        """
+        Return whether a URL is served by one of IMAGE_HOSTS or a subdomain of
+        one. Hosts that merely end with the same letters, like evilhulu.com,
+        don't count.
+        """
+
+        try:
+            parts = urlparse.urlsplit(url)
+        except (AttributeError, ValueError):
+            return False
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            return False
+
+        host = parts.hostname.rstrip(".")
+        return any(host == h or host.endswith("." + h)
+                for h in HuluSearch.IMAGE_HOSTS)
+
+    def get_known_image_urls(self, orig_image_urls, deadline=None):
+        """
+        Return a dict mapping each URL to the best image that's known for it
+        by the deadline, looking up any that aren't known yet. Lookups that
+        don't finish in time are left running in the background, and their
+        URLs, along with any that aren't Hulu images, map to themselves.
+        """
+
+        # only look up our own images, not whatever we happen to be given
+        ours = [url for url in orig_image_urls if HuluSearch.is_own_image(url)]
+        tasks = HuluSearch.resolve_image_urls(ours)
+
+        best = dict((url, url) for url in orig_image_urls)
+        for url in ours:
+            task = tasks.get(url)
+            if task is None:
+                best[url] = HuluSearch.image_cache.get(url, url)
+                continue
+
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+
+            # don't use tmap.outcomes here, since it would cancel a lookup
+            # that other callers may be waiting on too
+            if task.wait(remaining) and task.outcome().ok:
+                best[url] = task.value[url]
 
-        return best_url
+        return best
 
-    def find(self, query):
+    @staticmethod
+    def load_image_cache(path):
+        """Load image cache entries saved by save_image_cache, if any."""
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r') as f:
+            try:
+                HuluSearch.image_cache.load(json.load(f))
+            except ValueError:
+                # start over if the file is corrupt
+                pass
+
+    @staticmethod
+    def save_image_cache(path):
+        """Save the image cache to a file, so it survives restarts."""
+
+        # write to a temporary file first so a crash can't leave a partial one
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(HuluSearch.image_cache.dump(), f)
+        os.rename(temp_path, path)
+
+    def page_of(self, position=None, limit=None):
+        """
+        Return the page number and page size to ask for. Once a search has
+        started, its page size stays the same so the pages line up.
+        """
+
+        if position is not None:
+            return position["page"], position["size"]
+        return 1, min(limit or self.page_size, self.max_page_size)
+
+    def check_position(self, position):
+        position = Search.check_position(self, position)
+        if position is not None:
+            Search.position_int(position, "page", 1)
+            Search.position_int(position, "size", 1, self.max_page_size)
+        return position
+
+    def build_requests(self, query, deadline=None, position=None, limit=None):
         # don't do a search if there's no query
         if not isinstance(query, basestring) or query == "":
             return []
 
+        page, size = self.page_of(position, limit)
+
         # we make two requests, one for movies and one for TV shows. this is to
         # filter out useless clips and previews and the like.
         tv_params = {
-            "page": 1,
+            "page": page,
+            "items_per_page": size,
             "type": "episode",
             "site": "hulu",
             "query": query
         }
         movie_params = {
-            "page": 1,
+            "page": page,
+            "items_per_page": size,
             "type": "feature_film",
             "site": "hulu",
             "query": query
         }
 
         # build the requests
-        tv_request = arequests.get(self.search_url, params=tv_params)
-        movie_request = arequests.get(self.search_url, params=movie_params)
+        tv_request = arequests.get(self.search_url, params=tv_params,
+                deadline=deadline)
+        movie_request = arequests.get(self.search_url, params=movie_params,
+                deadline=deadline)
 
-        # get both requests and parse their XML payloads
-        tv_response, movie_response = arequests.map((tv_request, movie_request))
+        return [tv_request, movie_request]
 
-        tv_soup = bs4.BeautifulSoup(tv_response.text)
-        movie_soup = bs4.BeautifulSoup(movie_response.text)
+    def next_position(self, results, position=None, limit=None):
+        page, size = self.page_of(position, limit)
+
+        # series are made up from the episodes, so they don't count. there
+        # may be more of either type if we got a full page of it.
+        episodes = len([r for r in results
+                if isinstance(r, containers.EpisodeResult)])
+        movies = len([r for r in results
+                if isinstance(r, containers.MovieResult)])
+        if max(episodes, movies) < size:
+            return None
+
+        return {"page": page + 1, "size": size}
+
+    def parse(self, payloads):
+        if not payloads:
+            return []
+
+        tv_payload, movie_payload = payloads
+
+        # stream the results out of the payloads, falling back to the more
+        # forgiving (and much slower) parser if the markup is broken
+        try:
+            results = []
+
+            series_name_set = set()
+            for video in Search.iter_xml(tv_payload, "videos", "video"):
+                results.extend(self.parse_tv_video(video, series_name_set))
+
+            for video in Search.iter_xml(movie_payload, "videos", "video"):
+                results.append(self.parse_movie_video(video))
+
+            return results
+        except ElementTree.ParseError:
+            return self.parse_soup(payloads)
+
+    def parse_tv_video(self, video, series_name_set):
+        """
+        Turn a TV 'video' element into a list of results: the episode, preceded
+        by its series if the series isn't in series_name_set yet.
+        """
 
-        # the canonical results list
         results = []
 
-        # TODO: get all better image URLs at once, rather than piecemeal
+        # add series as well as episodes, but only if unique
+        canonical_name = Search.xml_text(video, "show", "canonical-name")
+        if canonical_name not in series_name_set:
+            sr = containers.SeriesResult(self.name)
+
+            sr.description = Search.xml_text(video, "show", "description")
+
+            # user rating for the show (no 'rating' element, apparently)
+            user_rating = float(Search.xml_text(video, "show",
+                    "user-star-rating"))
+            sr.rating_fraction = user_rating / self.rating_max
+
+            # link to the show page
+            sr.id = Search.xml_text(video, "show", "id")
+            sr.url = u"http://www.hulu.com/" + canonical_name
+
+            # the banner image for the show on the show page
+            sr.image_url = u"http://ib.huluim.com/show_art/" + sr.id
+            sr.image_url += u"?size=900x350&maintain_ratio=1"
+
+            sr.title = Search.xml_text(video, "show", "name")
+            sr.season_count = int(Search.xml_text(video, "show",
+                    "seasons-count"))
+            sr.episode_count = int(Search.xml_text(video, "show",
+                    "episodes-count"))
+
+            # add the series to the results
+            results.append(sr)
+
+            # add its name to the set so we don't add it to results again
+            series_name_set.add(canonical_name)
+
+        # add the episode itself
+        r = containers.EpisodeResult(self.name)
+
+        r.series_title = Search.xml_text(video, "show", "name")
+        r.title = Search.xml_text(video, "title")
+        r.season_number = int(Search.xml_text(video, "season-number"))
+        r.episode_number = int(Search.xml_text(video, "episode-number"))
+        r.description = Search.xml_text(video, "description")
+        r.rating_fraction = (float(Search.xml_text(video, "rating")) /
+                self.rating_max)
+        r.duration_seconds = int(float(Search.xml_text(video, "duration")))
+
+        r.id = Search.xml_text(video, "id")
+        r.url = u"http://www.hulu.com/watch/" + r.id
+        r.image_url = Search.xml_text(video, "thumbnail-url")
+
+        results.append(r)
+        return results
+
+    def parse_movie_video(self, video):
+        """Turn a movie 'video' element into a result."""
+
+        r = containers.MovieResult(self.name)
+
+        r.title = Search.xml_text(video, "title")
+        r.description = Search.xml_text(video, "description")
+        r.rating_fraction = (float(Search.xml_text(video, "rating")) /
+                self.rating_max)
+        r.duration_seconds = int(float(Search.xml_text(video, "duration")))
+
+        r.id = Search.xml_text(video, "id")
+        r.url = u"http://www.hulu.com/watch/" + r.id
+        r.image_url = Search.xml_text(video, "thumbnail-url")
+
+        return r
+
+    def parse_soup(self, payloads):
+        """Parse payloads with BeautifulSoup, which copes with broken markup."""
+
+        tv_payload, movie_payload = payloads
+        tv_soup = bs4.BeautifulSoup(tv_payload)
+        movie_soup = bs4.BeautifulSoup(movie_payload)
+
+        # the canonical results list
+        results = []
 
         series_name_set = set()
         for video in tv_soup.videos("video", recursive=False):
@@ -173,11 +813,11 @@ class HuluSearch(Search):
                 sr.rating_fraction = user_rating / self.rating_max
 
                 # link to the show page
+                sr.id = unicode(video.show.find("id").string)
                 sr.url = u"http://www.hulu.com/" + canonical_name
 
                 # the banner image for the show on the show page
-                sr.image_url = u"http://ib.huluim.com/show_art/"
-                sr.image_url += unicode(video.show.find("id").string)
+                sr.image_url = u"http://ib.huluim.com/show_art/" + sr.id
                 sr.image_url += u"?size=900x350&maintain_ratio=1"
 
                 sr.title = unicode(video.show.find("name").string)
@@ -201,9 +841,9 @@ class HuluSearch(Search):
             r.rating_fraction = float(video.rating.string) / self.rating_max
             r.duration_seconds = int(float(video.duration.string))
 
-            r.url = u"http://www.hulu.com/watch/" + video.id.string
-            r.image_url = HuluSearch.get_best_image_url(
-                    unicode(video.find("thumbnail-url").string))
+            r.id = unicode(video.id.string)
+            r.url = u"http://www.hulu.com/watch/" + r.id
+            r.image_url = unicode(video.find("thumbnail-url").string)
 
             results.append(r)
 
@@ -215,15 +855,41 @@ class HuluSearch(Search):
             r.rating_fraction = float(video.rating.string) / self.rating_max
             r.duration_seconds = int(float(video.duration.string))
 
-            r.url = u"http://www.hulu.com/watch/" + video.id.string
-            r.image_url = HuluSearch.get_best_image_url(
-                    unicode(video.find("thumbnail-url").string))
+            r.id = unicode(video.id.string)
+            r.url = u"http://www.hulu.com/watch/" + r.id
+            r.image_url = unicode(video.find("thumbnail-url").string)
 
             results.append(r)
 
         return results
 
-    def autocomplete(self, query):
+    def finish(self, results, query=None, deadline=None, position=None,
+            limit=None):
+        # swap thumbnails for larger images, leaving the series banners alone
+        thumbnailed = [r for r in results
+                if not isinstance(r, containers.SeriesResult)]
+
+        # use the images we already know about, and look up the rest without
+        # holding up the results. callers get them with get_known_image_urls.
+        if self.defer_images:
+            image_urls = [r.image_url for r in thumbnailed]
+            HuluSearch.resolve_image_urls(image_urls)
+            best_urls = dict((url, HuluSearch.image_cache.get(url, url))
+                    for url in image_urls)
+
+        # probe for every image at once. these are nice to have, so they wait
+        # behind more important work.
+        else:
+            with tmap.scheduling(tmap.BACKGROUND):
+                best_urls = HuluSearch.get_best_image_urls(
+                        [r.image_url for r in thumbnailed], deadline=deadline)
+
+        for r in thumbnailed:
+            r.image_url = best_urls[r.image_url]
+
+        return results
+
+    def autocomplete(self, query, deadline=None):
         # don't do a search if there's no query
         if not isinstance(query, basestring) or query == "":
             return []
@@ -232,7 +898,9 @@ class HuluSearch(Search):
             "query": query
         }
 
-        response = requests.get(self.autocomplete_url, params=params)
+        response = arequests.send(arequests.get(self.autocomplete_url,
+                params=params, deadline=deadline), deadline=deadline)
+        response.raise_for_status()
 
         # the second item of the response list is the list of results
         suggestions = []
@@ -244,7 +912,13 @@ class HuluSearch(Search):
         return suggestions
 
 class AmazonSearch(Search):
-    def __init__(self, config_file="multivid.conf"):
+    # details looked up with ItemLookup, shared by all instances. the API
+    # takes at most 10 items per lookup.
+    detail_cache = cache.LRUCache(4096)
+    DETAIL_BATCH_SIZE = 10
+
+    def __init__(self, config_file="multivid.conf", adaptive_pages=False,
+            enrich=False):
         # URLs we request data from
         self.search_url = "http://webservices.amazon.com/onca/xml"
         self.autocomplete_url = "http://completion.amazon.com/search/complete"
@@ -252,8 +926,20 @@ class AmazonSearch(Search):
         # the maximum rating a video may receive
         self.rating_max = 5.0
 
-        # the number of pages of results to retrieve from the API
+        # the number of pages of results to retrieve from the API when no limit
+        # is given, how many results come back on a full page, and the last
+        # page the API will return
         self.pages_to_get = 2
+        self.page_size = 10
+        self.max_pages = 10
+
+        # whether to only ask for the pages after the first once it's come
+        # back full, rather than asking for every page at once
+        self.adaptive_pages = adaptive_pages
+
+        # whether to look up descriptions and ratings for results, which the
+        # search doesn't return
+        self.enrich = enrich
 
         Search.__init__(self, config_file=config_file)
 
@@ -274,6 +960,9 @@ class AmazonSearch(Search):
         # quote and store all the keys and values of the sorted params
         query_string_builder = []
         for param, value in sorted(params.items()):
+            # requests sends unicode values as UTF-8, so that's what's signed
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
             query_string_builder.append(param)
             query_string_builder.append("=")
             query_string_builder.append(urllib.quote(str(value), "~"))
@@ -299,14 +988,44 @@ class AmazonSearch(Search):
         params["Signature"] = base64.b64encode(signer.digest())
         return params
 
-    def find(self, query):
+    def pages_for(self, position=None, limit=None):
+        """Return the list of page numbers needed to get limit results."""
+
+        first = position["page"] if position is not None else 1
+
+        count = self.pages_to_get
+        if limit is not None:
+            count = (limit + self.page_size - 1) // self.page_size
+
+        return range(first, min(first + count, self.max_pages + 1))
+
+    def check_position(self, position):
+        position = Search.check_position(self, position)
+        if position is not None:
+            Search.position_int(position, "page", 1, self.max_pages)
+        return position
+
+    def build_requests(self, query, deadline=None, position=None, limit=None):
         if not isinstance(query, basestring) or query == "":
             return []
 
+        # get all the pages of results at once, unless we're waiting to see if
+        # there are any more than the first
+        pages = self.pages_for(position, limit)
+        if self.adaptive_pages:
+            pages = pages[:1]
+
+        return [self.build_page_request(query, page, deadline=deadline)
+                for page in pages]
+
+    def build_page_request(self, query, page, deadline=None):
+        """Build the request for a single page of results, counting from 1."""
+
         # get the keys from the config
         public_key = self.config["amazon"]["public_key"]
         private_key = self.config["amazon"]["private_key"]
 
+        # each page needs its own signature, so they're signed separately
         params = AmazonSearch.build_params(
             "GET", public_key, private_key,
             Service="AWSECommerceService", # default according to docs
@@ -324,22 +1043,184 @@ class AmazonSearch(Search):
             # 'season' as a search term and using the related results to get
             # episode information.
 
-            Keywords=query
+            Keywords=query,
+            ItemPage=page
+        )
+
+        return arequests.get(self.search_url, params=params, deadline=deadline)
+
+    def parse(self, payloads):
+        # stream the items out of the payloads, falling back to the more
+        # forgiving (and much slower) parser if the markup is broken
+        try:
+            results = []
+
+            # pages can overlap, so only keep the first copy of each item
+            asins = set()
+            for payload in payloads:
+                for item in Search.iter_xml(payload, "Items", "Item"):
+                    r = self.parse_item(item)
+                    if r.id not in asins:
+                        asins.add(r.id)
+                        results.append(r)
+
+            return results
+        except ElementTree.ParseError:
+            return self.parse_soup(payloads)
+
+    def finish(self, results, query=None, deadline=None, position=None,
+            limit=None):
+        results = self.get_later_pages(results, query=query,
+                deadline=deadline, position=position, limit=limit)
+
+        if self.enrich:
+            self.fill_details(results, deadline=deadline)
+
+        return results
+
+    def get_later_pages(self, results, query=None, deadline=None,
+            position=None, limit=None):
+        """
+        In adaptive mode, add the results of the pages after the first if the
+        first came back full. Otherwise, returns the results unchanged.
+        """
+
+        # only a full first page means there might be more to get
+        pages = self.pages_for(position, limit)
+        if (not self.adaptive_pages or query is None or len(pages) < 2 or
+                len(results) < self.page_size):
+            return results
+
+        requests = [self.build_page_request(query, page, deadline=deadline)
+                for page in pages[1:]]
+        responses = arequests.map(requests, deadline=deadline)
+
+        # the later pages are nice to have, so skip any that didn't come back
+        # or whose body isn't a page of results.
+        seen = set(r.id for r in results)
+        results = list(results)
+        for response in responses:
+            if not response.ok:
+                continue
+
+            try:
+                page = self.parse(Search.payloads([response]))
+            except (ValueError, ElementTree.ParseError):
+                continue
+
+            results.extend(r for r in page if r.id not in seen)
+            seen.update(r.id for r in page)
+        return results
+
+    def build_details_request(self, asins, deadline=None):
+        # get the keys from the config
+        public_key = self.config["amazon"]["public_key"]
+        private_key = self.config["amazon"]["private_key"]
+
+        params = AmazonSearch.build_params(
+            "GET", public_key, private_key,
+            Service="AWSECommerceService",
+            AssociateTag="N/A",
+            Version="2011-08-01",
+            Operation="ItemLookup",
+            ResponseGroup="EditorialReview,Reviews",
+            ItemId=",".join(asins)
         )
 
-        # get all the pages of results at once
-        search_requests = []
-        for i in xrange(1, self.pages_to_get + 1):
-            r = arequests.get(self.search_url, params=params)
-            search_requests.append(r)
+        return arequests.get(self.search_url, params=params, deadline=deadline)
+
+    def parse_details(self, payload):
+        details = {}
+        for item in Search.iter_xml(payload, "Items", "Item"):
+            fields = {}
+
+            # reviews come back as HTML, so only their text is kept
+            review = Search.xml_find(item, "EditorialReview", "Content")
+            if review is not None and review.text:
+                soup = bs4.BeautifulSoup(review.text)
+                fields["description"] = unicode(soup.get_text()).strip()
+
+            # only some items still come back with their average rating
+            rating = Search.xml_find(item, "AverageRating")
+            if rating is not None and rating.text:
+                fields["rating_fraction"] = float(rating.text) / self.rating_max
+
+            details[Search.xml_text(item, "ASIN")] = fields
+
+        return details
+
+    def next_position(self, results, position=None, limit=None):
+        # there may be more if every page we asked for was full
+        pages = self.pages_for(position, limit)
+        if (len(pages) == 0 or pages[-1] >= self.max_pages or
+                len(results) < len(pages) * self.page_size):
+            return None
+
+        return {"page": pages[-1] + 1}
+
+    def parse_item(self, item):
+        """Turn an 'Item' element into a result."""
+
+        attrs = Search.xml_find(item, "ItemAttributes")
+
+        # handle the different result types
+        if "movie" in Search.xml_text(attrs, "ProductGroup").lower():
+            r = containers.MovieResult(self.name)
+            r.title = Search.xml_text(attrs, "Title")
+        else:
+            r = containers.EpisodeResult(self.name)
+
+            # prefix the title with the season name if possible
+            rel_attrs = Search.xml_find(item, "RelatedItems", "ItemAttributes")
+            if rel_attrs is not None:
+                # make sure it's a TV season
+                prod_group = Search.xml_text(rel_attrs, "ProductGroup")
+                if "season" in prod_group.lower():
+                    # get the show title
+                    r.series_title = Search.xml_text(rel_attrs, "Title")
+
+                    # get the season number
+                    r.season_number = int(Search.xml_text(rel_attrs,
+                            "EpisodeSequence"))
+
+            r.title = Search.xml_text(attrs, "Title")
+            r.episode_number = int(Search.xml_text(attrs, "EpisodeSequence"))
+
+        r.id = Search.xml_text(item, "ASIN")
+        r.url = Search.xml_text(item, "DetailPageURL")
+
+        # only add the image if one is present
+        image_url = Search.xml_find(item, "LargeImage", "URL")
+        if image_url is not None:
+            r.image_url = unicode(image_url.text or u"")
 
-        # get all the items from the responses as soup objects
+        # occasionally, there isn't a running time
+        for mins in attrs.iter("RunningTime"):
+            if mins.get("Units") == "minutes":
+                r.duration_seconds = 60 * int(mins.text)
+                break
+
+        # NOTE: description and rating_fraction don't come back in the
+        # results. finish looks them up if enrich is set.
+
+        return r
+
+    def parse_soup(self, payloads):
+        """Parse payloads with BeautifulSoup, which copes with broken markup."""
+
+        # get all the items from the payloads as soup objects
         results = []
-        for response in arequests.map(search_requests):
-            soup = bs4.BeautifulSoup(response.text)
+        asins = set()
+        for payload in payloads:
+            soup = bs4.BeautifulSoup(payload)
 
-            # iterate over all the item nodes
+            # iterate over all the item nodes, skipping any we've already seen
             for item in soup.items("item", recursive=False):
+                asin = unicode(item.asin.string)
+                if asin in asins:
+                    continue
+                asins.add(asin)
+
                 attrs = item.itemattributes
 
                 # handle the different result types
@@ -365,6 +1246,7 @@ class AmazonSearch(Search):
                     r.title = unicode(attrs.title.string)
                     r.episode_number = int(attrs.episodesequence.string)
 
+                r.id = asin
                 r.url = unicode(item.detailpageurl.string)
 
                 # only add the image if one is present
@@ -378,13 +1260,13 @@ class AmazonSearch(Search):
                     r.duration_seconds = 60 * minutes
 
                 # NOTE: description and rating_fraction don't come back in the
-                # results, and would take a long time to scrape, so we don't.
+                # results. finish looks them up if enrich is set.
 
                 results.append(r)
 
         return results
 
-    def autocomplete(self, query):
+    def autocomplete(self, query, deadline=None):
         if not isinstance(query, basestring) or query == "":
             return []
 
@@ -396,7 +1278,9 @@ class AmazonSearch(Search):
             "q": query
         }
 
-        response = requests.get(self.autocomplete_url, params=params)
+        response = arequests.send(arequests.get(self.autocomplete_url,
+                params=params, deadline=deadline), deadline=deadline)
+        response.raise_for_status()
 
         # the second item of the response list is the list of results
         suggestions = []
@@ -408,6 +1292,10 @@ class AmazonSearch(Search):
         return suggestions
 
 class NetflixSearch(Search):
+    # details looked up with the bulk title API, shared by all instances
+    detail_cache = cache.LRUCache(4096)
+    DETAIL_BATCH_SIZE = 50
+
     def __init__(self, config_file="multivid.conf"):
         base_url = "http://api-public.netflix.com"
         self.search_url = base_url + "/catalog/titles"
@@ -416,6 +1304,9 @@ class NetflixSearch(Search):
         # the maximum number of starts a title may be rated
         self.rating_max = 5.0
 
+        # how many results to ask for when no limit is given
+        self.page_size = 25
+
         Search.__init__(self, config_file=config_file)
 
     @staticmethod
@@ -444,6 +1335,9 @@ class NetflixSearch(Search):
         # build the parameter string (alphabetical)
         param_str_builder = []
         for param, value in sorted(params.items()):
+            # requests sends unicode values as UTF-8, so that's what's signed
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
             param_str_builder.append(param)
             param_str_builder.append("=")
             # must double-escape param values, once here and again later
@@ -465,7 +1359,7 @@ class NetflixSearch(Search):
         params["oauth_signature"] = base64.b64encode(signer.digest())
         return params
 
-    def find(self, query):
+    def build_requests(self, query, deadline=None, position=None, limit=None):
         if not isinstance(query, basestring) or query == "":
             return []
 
@@ -479,7 +1373,8 @@ class NetflixSearch(Search):
             output="json", # we want JSON responses, not XML
 
             # don't get too many results at once
-            max_results=25,
+            start_index=position["start"] if position is not None else 0,
+            max_results=limit or self.page_size,
 
             # we only want instant streaming results
             filters="http://api.netflix.com/categories/title_formats/instant",
@@ -490,11 +1385,62 @@ class NetflixSearch(Search):
             term=query
         )
 
-        response = requests.get(self.search_url, params=params)
+        return [arequests.get(self.search_url, params=params,
+                deadline=deadline)]
+
+    def finish(self, results, query=None, deadline=None, position=None,
+            limit=None):
+        # fill in the durations the search didn't give us
+        self.fill_details([r for r in results
+                if isinstance(r, containers.MovieResult)
+                and r.duration_seconds is None], deadline=deadline)
+
+        return results
+
+    def build_details_request(self, title_ids, deadline=None):
+        """Build a bulk title API request for the given title ids."""
+
+        # get the keys from the config
+        public_key = self.config["netflix"]["public_key"]
+        private_key = self.config["netflix"]["private_key"]
+
+        params = NetflixSearch.build_params(
+            "POST", self.search_url, public_key, private_key,
+            v=2.0,
+            output="json",
+            title_refs=",".join(title_ids)
+        )
+
+        return arequests.post(self.search_url, data=params, deadline=deadline)
+
+    def parse_details(self, payload):
+        data = json.loads(payload)
+        return dict((item["id"], {"duration_seconds": item.get("runtime")})
+                for item in data.get("catalog", []))
 
+    def next_position(self, results, position=None, limit=None):
+        # there may be more if we got as many as we asked for
+        start = position["start"] if position is not None else 0
+        size = limit or self.page_size
+        if len(results) < size:
+            return None
+
+        return {"start": start + size}
+
+    def check_position(self, position):
+        position = Search.check_position(self, position)
+        if position is not None:
+            Search.position_int(position, "start", 0)
+        return position
+
+    def parse(self, payloads):
         results = []
-        if "catalog" in response.json:
-            for item in response.json["catalog"]:
+        for payload in payloads:
+            data = json.loads(payload)
+            if "catalog" not in data:
+                continue
+
+            for item in data["catalog"]:
 
                 # figure out what kind of result we're dealing with
                 if "movie" in item["id"]:
@@ -504,6 +1450,7 @@ class NetflixSearch(Search):
                     r.episode_count = item["episode_count"]
                     r.season_count = item["season_count"]
 
+                r.id = item["id"]
                 r.title = item["title"]["regular"]
                 r.description = item["synopsis"]["regular"]
                 r.rating_fraction = item["average_rating"] / self.rating_max
@@ -519,9 +1466,10 @@ class NetflixSearch(Search):
                         image_url = url
                 r.image_url = image_url
 
-                # NOTE: no duration information comes back, so we don't fill it
-                # out.  this could be remedied with the bulk request API, if
-                # necessary.
+                # NOTE: the duration rarely comes back with search results, so
+                # finish fills it in using the bulk title API.
+                if "runtime" in item and isinstance(r, containers.MovieResult):
+                    r.duration_seconds = item["runtime"]
 
                 # NOTE: episodes aren't directly returned as part of the search,
                 # only (seemingly) as part of a series. since series are much
@@ -531,7 +1479,7 @@ class NetflixSearch(Search):
 
         return results
 
-    def autocomplete(self, query):
+    def autocomplete(self, query, deadline=None):
         if not isinstance(query, basestring) or query == "":
             return []
 
@@ -542,7 +1490,9 @@ class NetflixSearch(Search):
             "term": query
         }
 
-        response = requests.get(self.autocomplete_url, params=params)
+        response = arequests.send(arequests.get(self.autocomplete_url,
+                params=params, deadline=deadline), deadline=deadline)
+        response.raise_for_status()
 
         # if there are no results, some fields might not exist
         if "autocomplete" in response.json:
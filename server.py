@@ -5,10 +5,64 @@ import os
 import bottle
 
 import multivid
+import tmap
 
 # where static files are kept
 STATIC_FILES_ROOT = os.path.abspath("static")
 
+# how long, in milliseconds, a search may take before we answer with whatever
+# providers have responded so far. may be lowered per-request with 'budget_ms',
+# but not below MIN_BUDGET_MS.
+AUTOCOMPLETE_BUDGET_MS = 1000
+FIND_BUDGET_MS = 3000
+IMAGES_BUDGET_MS = 3000
+MIN_BUDGET_MS = 250
+
+# the most results a client may ask each provider for at once
+MAX_FIND_LIMIT = 50
+
+# the most image URLs a client may ask to have improved at once
+MAX_IMAGE_URLS = 50
+
+# whether to open connections to every upstream host before serving
+PREWARM_CONNECTIONS = True
+
+# how many processes to parse responses with. if 0, parsing happens on the
+# threads that fetched the responses.
+PARSE_PROCESSES = 0
+
+def budget(default_ms):
+    """
+    Get the time budget for the current request, capped at the default and
+    raised to MIN_BUDGET_MS. Aborts the request if the budget given isn't a
+    whole number of milliseconds.
+    """
+
+    budget_ms = bottle.request.query.get("budget_ms")
+    if budget_ms is None:
+        return default_ms
+
+    try:
+        budget_ms = int(budget_ms)
+    except ValueError:
+        bottle.abort(400, "Invalid budget_ms.")
+    if budget_ms < 0:
+        bottle.abort(400, "Invalid budget_ms.")
+
+    return max(min(budget_ms, default_ms), min(MIN_BUDGET_MS, default_ms))
+
+def respond(query, results):
+    """Build the JSON response for a list of results."""
+
+    return {
+        "query": query,
+        "results": [r.to_dict() for r in results],
+        "timed_out": results.timed_out,
+        "failed": results.failed,
+        "skipped": results.skipped,
+        "cursor": results.cursor
+    }
+
 @bottle.route("/")
 def index():
     return bottle.static_file("index.html", root=STATIC_FILES_ROOT)
@@ -20,20 +74,58 @@ def serve_static(filename):
 @bottle.get("/search/autocomplete")
 def autocomplete():
     query = bottle.request.query["query"]
-    results = multivid.autocomplete(query)
-    return {
-        "query": query,
-        "results": [r.to_dict() for r in results]
-    }
+    results = multivid.autocomplete(query,
+            budget_ms=budget(AUTOCOMPLETE_BUDGET_MS))
+    return respond(query, results)
 
 @bottle.get("/search/find")
 def find():
     query = bottle.request.query["query"]
-    results = multivid.find(query)
+
+    # the cursor from the previous page, if this isn't the first
+    cursor = bottle.request.query.get("cursor") or None
+
+    limit = bottle.request.query.get("limit")
+    if limit is not None:
+        try:
+            limit = max(1, min(int(limit), MAX_FIND_LIMIT))
+        except ValueError:
+            bottle.abort(400, "Invalid limit.")
+
+    # check the cursor up front, so errors from the search itself aren't
+    # mistaken for a bad cursor
+    try:
+        multivid.positions_for(cursor)
+    except ValueError:
+        bottle.abort(400, "Invalid cursor.")
+
+    results = multivid.find(query, budget_ms=budget(FIND_BUDGET_MS),
+            cursor=cursor, limit=limit)
+    return respond(query, results)
+
+@bottle.get("/search/images")
+def images():
+    # the image URLs of earlier results, each given as its own 'url' param
+    image_urls = bottle.request.query.getall("url")
+    if len(image_urls) > MAX_IMAGE_URLS:
+        bottle.abort(400, "Too many image URLs.")
+
     return {
-        "query": query,
-        "results": [r.to_dict() for r in results]
+        "images": multivid.images(image_urls,
+                budget_ms=budget(IMAGES_BUDGET_MS))
     }
 
+@bottle.get("/stats")
+def stats():
+    return multivid.stats()
+
+multivid.configure()
+
+if PARSE_PROCESSES > 0:
+    multivid.PARSE_POOL = tmap.ProcessPool(PARSE_PROCESSES)
+
+if PREWARM_CONNECTIONS:
+    multivid.prewarm(budget_ms=FIND_BUDGET_MS)
+
 bottle.debug(True)
 bottle.run(host="localhost", port=8080, reloader=True)
@@ -102,12 +102,42 @@ var ResultList = Backbone.Collection.extend({
     model: Result,
     url: '/search/find',
 
+    imagesUrl: '/search/images',
+
+    // how many results to ask each provider for, and the cursor for the next
+    // page of results, if there is one
+    limit: 10,
+    cursor: null,
+
     updateResults: function (query) {
-        var xhr = $.getJSON(this.url, {'query': query});
+        var xhr = $.getJSON(this.url, {'query': query, 'limit': this.limit});
 
-        // update the collection on reset
+        // update the collection on reset, then look for better images
         xhr.success(_.bind(function (data) {
+            this.cursor = data.cursor;
             this.reset(data.results);
+            this.updateImages();
+        }, this));
+    },
+
+    updateImages: function () {
+        var imageUrls = _.compact(_.uniq(this.pluck('image_url')));
+        if (imageUrls.length === 0) {
+            return;
+        }
+
+        // send each url as its own 'url' param
+        var xhr = $.getJSON(this.imagesUrl,
+                $.param({'url': imageUrls}, true));
+
+        // swap in any better images, unless the results have changed since
+        xhr.success(_.bind(function (data) {
+            this.each(function (result) {
+                var best = data.images[result.get('image_url')];
+                if (best) {
+                    result.set({'image_url': best});
+                }
+            });
         }, this));
     }
 });
@@ -127,6 +157,7 @@ var ResultListView = Backbone.View.extend({
 
     initialize: function (models, options) {
         this.collection.on('reset', this.render, this);
+        this.collection.on('change:image_url', this.renderImage, this);
 
         // build the container and add it to the body
         this.setElement($(this.template()));
@@ -145,12 +176,13 @@ var ResultListView = Backbone.View.extend({
         // NOTE: functions identically to the render in the AC suggestions
 
         var brandResults = {};
-        _.each(this.collection.toJSON(), function (result) {
-            if (!brandResults[result.provider]) {
-                brandResults[result.provider] = [];
+        this.collection.each(function (result) {
+            var provider = result.get('provider');
+            if (!brandResults[provider]) {
+                brandResults[provider] = [];
             }
 
-            brandResults[result.provider].push(result);
+            brandResults[provider].push(result);
         }, this);
 
         while (_.flatten(brandResults).length >
@@ -161,12 +193,25 @@ var ResultListView = Backbone.View.extend({
         this.$el.children().remove();
 
         _.each(_.flatten(brandResults), function (result) {
-            this.$el.append(this.itemTemplate(result));
+            var $result = $(this.itemTemplate(result.toJSON()));
+
+            // remember which result it is, so its image can be swapped later
+            $result.data('cid', result.cid);
+            this.$el.append($result);
         }, this);
 
         return this;
     },
 
+    renderImage: function (result) {
+        // swap the image of an already rendered result in place
+        var url = 'url(' + result.get('image_url') + ')';
+        this.$el.children().filter(function () {
+            return $(this).data('cid') === result.cid;
+        }).css('background-image', url).find('.img-large')
+            .css('background-image', url);
+    },
+
     clickResult: function (e) {
         // hide any expanded results, show the newly clicked one
         var expandedClass = 'expanded'
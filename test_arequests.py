@@ -0,0 +1,293 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+import urlparse
+
+from requests import models
+
+import arequests
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers with the status, delay, and headers given in the query string,
+    and counts the requests made to each path.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+
+        with self.server.lock:
+            self.server.hits[url.path] = self.server.hits.get(url.path, 0) + 1
+            hit = self.server.hits[url.path]
+
+        time.sleep(float(params.pop("delay", 0)))
+
+        # 'fail' is how many of the first requests get a 503
+        status = int(params.pop("status", 200))
+        if hit <= int(params.pop("fail", 0)):
+            status = 503
+
+        body = url.path
+        self.send_response(status)
+        for name, value in params.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a local HTTP server for the length of each test."""
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.hits = {}
+        self.server.lock = threading.Lock()
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # responses aren't cached between tests
+        self.saved_cache = arequests.http_cache
+        arequests.http_cache = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        arequests.http_cache = self.saved_cache
+
+    def url(self, path, **params):
+        url = "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+        if params:
+            url += "?" + "&".join("%s=%s" % kv for kv in params.items())
+        return url
+
+    def hits(self, path):
+        return self.server.hits.get(path, 0)
+
+def response_for(request, status_code=200, headers=None, content="body"):
+    response = models.Response()
+    response.request = request
+    response.url = request.url
+    response.status_code = status_code
+    response.headers = headers or {}
+    response._content = content
+    return response
+
+class HTTPCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = arequests.HTTPCache()
+        self.sent = []
+
+    def transmit(self, status_code=200, headers=None):
+        def transmit(request):
+            self.sent.append(request)
+            return response_for(request, status_code, headers)
+        return transmit
+
+    def test_signed_params_share_a_key(self):
+        first = arequests.get("http://example.com/search",
+                params={"q": "x", "Timestamp": "1", "Signature": "a"})
+        second = arequests.get("http://EXAMPLE.com/search",
+                params={"q": "x", "Timestamp": "2", "Signature": "b"})
+
+        self.assertEqual(arequests.HTTPCache.key(first),
+                arequests.HTTPCache.key(second))
+
+    def test_non_ascii_params(self):
+        # queries come from bottle as UTF-8 byte strings
+        as_bytes = arequests.get("http://example.com/search",
+                params={"q": "caf\xc3\xa9", "n": 1})
+        as_unicode = arequests.get("http://example.com/search?n=1",
+                params={u"q": u"caf\xe9"})
+
+        key = arequests.HTTPCache.key(as_bytes)
+        self.assertEqual(key, arequests.HTTPCache.key(as_unicode))
+        self.assertEqual(key[-1], "n=1&q=caf%C3%A9")
+
+        response = self.cache.send(as_bytes, self.transmit())
+        self.assertEqual(response.status_code, 200)
+
+    def test_freshness(self):
+        request = arequests.get("http://example.com/")
+        def fresh_for(headers):
+            return arequests.HTTPCache.freshness(
+                    response_for(request, headers=headers))
+
+        self.assertEqual(fresh_for({"cache-control": "public, max-age=60"}),
+                60)
+        self.assertEqual(fresh_for({"cache-control": "no-cache"}), 0)
+        self.assertEqual(fresh_for({"cache-control": "no-store"}), None)
+        self.assertEqual(fresh_for({
+            "date": "Thu, 01 Jan 2015 00:00:00 GMT",
+            "expires": "Thu, 01 Jan 2015 00:02:00 GMT"
+        }), 120)
+
+    def test_fresh_responses_are_served_from_the_cache(self):
+        transmit = self.transmit(headers={"cache-control": "max-age=60"})
+        first = self.cache.send(arequests.get("http://example.com/"), transmit)
+        second = self.cache.send(arequests.get("http://example.com/"),
+                transmit)
+
+        self.assertIs(first, second)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_stale_responses_are_revalidated(self):
+        self.cache.send(arequests.get("http://example.com/"),
+                self.transmit(headers={"etag": '"v1"'}))
+
+        # a 304 means the stored response is still good
+        response = self.cache.send(arequests.get("http://example.com/"),
+                self.transmit(status_code=304))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sent[-1].headers["If-None-Match"], '"v1"')
+
+    def test_only_gets_and_heads_are_cached(self):
+        transmit = self.transmit(headers={"cache-control": "max-age=60"})
+        for i in xrange(2):
+            self.cache.send(arequests.post("http://example.com/"), transmit)
+
+        self.assertEqual(len(self.sent), 2)
+
+class HedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hedger = arequests.Hedger(budget=1.0, min_samples=5)
+        self.threads = []
+
+        # teach the hedger that the host answers in about 50ms
+        for i in xrange(5):
+            self.hedger.timed("example.com", self.transmit(0.05),
+                    arequests.get("http://example.com/"))
+        self.threads = []
+
+    def transmit(self, *delays, **kwargs):
+        """
+        Build a transmit function whose nth call takes the nth delay and
+        answers with the nth of the given status codes.
+        """
+
+        statuses = list(kwargs.get("statuses", [200] * len(delays)))
+        delays = list(delays)
+        def transmit(request):
+            self.threads.append(threading.current_thread())
+            delay, status_code = delays.pop(0), statuses.pop(0)
+            time.sleep(delay)
+            return response_for(request, status_code)
+        return transmit
+
+    def test_hosts_without_samples_are_not_hedged(self):
+        response = self.hedger.send(arequests.get("http://example.org/"),
+                self.transmit(0.2, 0.0))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.threads), 1)
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_requests_are_sent_from_the_calling_thread(self):
+        self.hedger.send(arequests.get("http://example.com/"),
+                self.transmit(0.0))
+
+        self.assertEqual(self.threads, [threading.current_thread()])
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_slow_requests_are_copied_after_the_delay(self):
+        started = time.time()
+        response = self.hedger.send(arequests.get("http://example.com/"),
+                self.transmit(0.3, 0.0))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.hedger.hedges, 1)
+        self.assertEqual(len(self.threads), 2)
+        self.assertIsNot(self.threads[1], threading.current_thread())
+        self.assertTrue(time.time() - started >= 0.3)
+
+    def test_copy_is_used_when_the_first_fails(self):
+        response = self.hedger.send(arequests.get("http://example.com/"),
+                self.transmit(0.3, 0.0, statuses=[503, 200]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.hedger.wins, 1)
+
+    def test_posts_are_not_hedged(self):
+        self.hedger.send(arequests.post("http://example.com/"),
+                self.transmit(0.3, 0.0))
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_budget_caps_hedges(self):
+        self.hedger.budget = 0.0
+        self.hedger.send(arequests.get("http://example.com/"),
+                self.transmit(0.3, 0.0))
+
+        time.sleep(0.05)
+        self.assertEqual(self.hedger.hedges, 0)
+        self.assertEqual(len(self.threads), 1)
+
+class SessionTest(unittest.TestCase):
+
+    def test_hosts_share_a_session(self):
+        first = arequests.get("http://example.com/a")
+        second = arequests.get("http://EXAMPLE.com/b")
+        other = arequests.get("http://example.org/")
+
+        self.assertIs(first.session, second.session)
+        self.assertIsNot(first.session, other.session)
+
+    def test_url_may_be_given_by_keyword(self):
+        request = arequests.request("GET", url="http://example.com/")
+        self.assertEqual(request.url, "http://example.com/")
+        self.assertIs(request.session,
+                arequests.session_for("http://example.com/"))
+
+    def test_url_is_required(self):
+        self.assertRaises(TypeError, arequests.get)
+
+class SendTest(ServerTestCase):
+
+    def test_prefetch_is_left_to_the_caller(self):
+        request = arequests.get(self.url("/lazy"))
+        response = arequests.map([request], prefetch=False)[0]
+
+        self.assertFalse(response._content_consumed)
+        self.assertEqual(response.content, "/lazy")
+
+    def test_transient_failures_are_sent_again(self):
+        response = arequests.send(arequests.get(self.url("/flaky", fail=1)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.hits("/flaky"), 2)
+
+    def test_imap_yields_responses_as_they_arrive(self):
+        requests = [arequests.get(self.url("/slow", delay=0.3)),
+                arequests.get(self.url("/fast"))]
+
+        responses = list(arequests.imap(requests, size=2))
+        self.assertEqual([r.content for r in responses], ["/fast", "/slow"])
+
+    def test_imap_pulls_requests_lazily(self):
+        pulled = []
+        def requests():
+            for i in xrange(10):
+                pulled.append(i)
+                yield arequests.get(self.url("/item%d" % i))
+
+        responses = arequests.imap(requests(), size=2)
+        responses.next()
+        self.assertTrue(len(pulled) <= 3, pulled)
+        responses.close()
+
+if __name__ == "__main__":
+    unittest.main()
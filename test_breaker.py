@@ -0,0 +1,63 @@
+import time
+import unittest
+
+import breaker
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_enough_failures_in_a_row(self):
+        b = breaker.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        b.failure()
+        b.success()
+        b.failure()
+        self.assertTrue(b.allow())
+
+        b.failure()
+        self.assertFalse(b.allow())
+        self.assertEqual(b.stats()["state"], breaker.CircuitBreaker.OPEN)
+        self.assertEqual(b.stats()["refusals"], 1)
+
+    def test_half_open_lets_one_trial_call_through(self):
+        b = breaker.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        b.failure()
+        time.sleep(0.02)
+
+        self.assertTrue(b.allow())
+        self.assertFalse(b.allow())
+        self.assertEqual(b.state, breaker.CircuitBreaker.HALF_OPEN)
+
+    def test_trial_result_closes_or_reopens(self):
+        b = breaker.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        b.failure()
+        time.sleep(0.02)
+        b.allow()
+        b.failure()
+        self.assertEqual(b.state, breaker.CircuitBreaker.OPEN)
+
+        time.sleep(0.02)
+        b.allow()
+        b.success()
+        self.assertEqual(b.state, breaker.CircuitBreaker.CLOSED)
+        self.assertTrue(b.allow())
+
+    def test_inconclusive_trial_lets_another_through(self):
+        b = breaker.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        b.failure()
+        time.sleep(0.02)
+        b.allow()
+
+        b.inconclusive()
+        self.assertTrue(b.allow())
+        self.assertEqual(b.state, breaker.CircuitBreaker.HALF_OPEN)
+
+    def test_inconclusive_calls_do_not_count(self):
+        b = breaker.CircuitBreaker(failure_threshold=1)
+        for i in xrange(3):
+            b.inconclusive()
+
+        self.assertEqual(b.state, breaker.CircuitBreaker.CLOSED)
+        self.assertEqual(b.failures, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import time
+import unittest
+
+import cache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        c = cache.LRUCache(2)
+        c.set("a", 1)
+        c.set("b", 2)
+
+        # using 'a' makes 'b' the oldest
+        self.assertEqual(c.get("a"), 1)
+        c.set("c", 3)
+
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual(c.stats()["evictions"], 1)
+
+    def test_evicts_to_stay_under_max_bytes(self):
+        c = cache.LRUCache(10, max_bytes=10)
+        c.set("a", "x", size=6)
+        c.set("b", "y", size=6)
+
+        self.assertEqual(c.get("a"), None)
+        self.assertEqual(c.get("b"), "y")
+        self.assertEqual(c.stats()["bytes"], 6)
+
+    def test_expired_entries_are_missing(self):
+        c = cache.LRUCache()
+        c.set("a", 1, ttl=-1)
+        c.set("b", 2, ttl=60)
+
+        self.assertEqual(c.get("a", "gone"), "gone")
+        self.assertEqual(c.get("b"), 2)
+
+    def test_dump_and_load_skip_expired_entries(self):
+        c = cache.LRUCache()
+        c.set("a", 1)
+        c.set("b", 2, ttl=60)
+
+        loaded = cache.LRUCache()
+        loaded.load(c.dump() + [("c", 3, time.time() - 1)])
+
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.get("a"), 1)
+        self.assertEqual(loaded.get("b"), 2)
+
+    def test_pop_and_clear(self):
+        c = cache.LRUCache()
+        c.set("a", 1)
+        c.set("b", 2)
+
+        self.assertEqual(c.pop("a"), 1)
+        self.assertEqual(c.pop("a", "gone"), "gone")
+        self.assertEqual(len(c), 1)
+
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+if __name__ == "__main__":
+    unittest.main()
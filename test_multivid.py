@@ -0,0 +1,396 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from requests import exceptions
+
+import arequests
+import breaker
+import containers
+import multivid
+import search
+import throttle
+
+class FakeSearch(search.Search):
+    """
+    A searcher that answers from memory. Each find sends the requests it's
+    given the URLs of, then takes delay seconds to parse and raises error if
+    one is set.
+    """
+
+    def __init__(self, name, delay=0.0, error=None, urls=()):
+        search.Search.__init__(self, name=name, config_file=None)
+        self.delay = delay
+        self.error = error
+        self.request_urls = list(urls)
+        self.calls = 0
+
+    def build_requests(self, query, deadline=None, position=None, limit=None):
+        return [arequests.get(url, deadline=deadline)
+                for url in self.request_urls]
+
+    def parse(self, payloads):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+        r = containers.MovieResult(self.name)
+        r.id = u"%s-%d" % (self.name, self.calls)
+        return [r]
+
+    def fetch(self, query, deadline=None, position=None, limit=None):
+        return []
+
+    def autocomplete(self, query, deadline=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+        s = containers.Suggestion(self.name)
+        s.suggestion = query
+        return [s]
+
+class PagedSearch(FakeSearch):
+    """A FakeSearch whose results come in count pages."""
+
+    def __init__(self, name, count, **kwargs):
+        FakeSearch.__init__(self, name, **kwargs)
+        self.count = count
+        self.positions = []
+
+    def build_requests(self, query, deadline=None, position=None, limit=None):
+        self.positions.append(position)
+        return FakeSearch.build_requests(self, query, deadline=deadline,
+                position=position, limit=limit)
+
+    def check_position(self, position):
+        position = search.Search.check_position(self, position)
+        if position is not None:
+            search.Search.position_int(position, "page", 1, self.count)
+        return position
+
+    def next_position(self, results, position=None, limit=None):
+        page = position["page"] if position is not None else 1
+        if page >= self.count:
+            return None
+        return {"page": page + 1}
+
+class MultividTestCase(unittest.TestCase):
+    """Swaps in fake searchers, and puts everything back afterwards."""
+
+    def setUp(self):
+        self.saved = (multivid.SEARCHERS, multivid.BREAKERS,
+                multivid.RESULT_CACHE, arequests.send)
+        multivid.RESULT_CACHE.clear()
+
+    def tearDown(self):
+        (multivid.SEARCHERS, multivid.BREAKERS, multivid.RESULT_CACHE,
+                arequests.send) = self.saved
+        multivid.RESULT_CACHE.clear()
+
+    def use(self, *searchers):
+        multivid.SEARCHERS = list(searchers)
+        multivid.BREAKERS = dict((s.name, breaker.CircuitBreaker())
+                for s in searchers)
+
+    def fail_sends(self, error):
+        """Make every request that's sent come back failed with error."""
+
+        arequests.send = lambda r, *args, **kwargs: arequests.failed(r, error)
+
+    def answer_sends(self, status_code):
+        """Make every request that's sent come back with status_code."""
+
+        def send(request, *args, **kwargs):
+            response = arequests.failed(request, None)
+            response.status_code = status_code
+            response._content = ""
+            return response
+        arequests.send = send
+
+class DeadlineTest(MultividTestCase):
+
+    def test_raising_searchers_are_failed(self):
+        self.use(FakeSearch("good"), FakeSearch("bad", error=ValueError()))
+
+        results = multivid.find(u"query")
+        self.assertEqual([r.provider for r in results], [u"good"])
+        self.assertEqual(results.failed, [u"bad"])
+
+    def test_late_searchers_are_timed_out(self):
+        self.use(FakeSearch("fast"), FakeSearch("slow", delay=0.5))
+
+        started = time.time()
+        results = multivid.find(u"query", budget_ms=100)
+        self.assertTrue(time.time() - started < 0.4)
+
+        self.assertEqual([r.provider for r in results], [u"fast"])
+        self.assertEqual(results.timed_out, [u"slow"])
+        self.assertEqual(results.failed, [])
+
+    def test_requests_given_up_on_are_timed_out(self):
+        self.use(FakeSearch("late", urls=["http://late.example.invalid/"]))
+        self.fail_sends(exceptions.Timeout("deadline passed"))
+
+        results = multivid.find(u"query", budget_ms=1000)
+        self.assertEqual(results.timed_out, [u"late"])
+        self.assertEqual(results.failed, [])
+
+    def test_autocomplete_returns_partial_results(self):
+        self.use(FakeSearch("fast"), FakeSearch("slow", delay=0.5),
+                FakeSearch("bad", error=ValueError()))
+
+        results = multivid.autocomplete(u"query", budget_ms=100)
+        self.assertEqual([s.provider for s in results], [u"fast"])
+        self.assertEqual(results.timed_out, [u"slow"])
+        self.assertEqual(results.failed, [u"bad"])
+
+class CursorTest(MultividTestCase):
+
+    def test_only_searchers_with_more_are_asked_again(self):
+        short, longer = PagedSearch("short", 1), PagedSearch("long", 3)
+        self.use(short, longer)
+
+        first = multivid.find(u"query")
+        second = multivid.find(u"query", cursor=first.cursor)
+        third = multivid.find(u"query", cursor=second.cursor)
+
+        self.assertEqual([r.provider for r in second], [u"long"])
+        self.assertEqual(short.positions, [None])
+        self.assertEqual(longer.positions, [None, {"page": 2}, {"page": 3}])
+        self.assertEqual(third.cursor, None)
+
+    def test_searchers_that_fail_are_asked_for_the_same_page(self):
+        searcher = PagedSearch("flaky", 3)
+        self.use(searcher)
+
+        first = multivid.find(u"query")
+        searcher.error = ValueError()
+        second = multivid.find(u"query", cursor=first.cursor)
+
+        self.assertEqual(second.failed, [u"flaky"])
+        self.assertEqual(second.cursor, first.cursor)
+
+    def test_bad_cursors_raise_value_error(self):
+        self.use(PagedSearch("paged", 3))
+
+        bad = search.Search.encode_cursor({u"paged": {"page": 4}})
+        for cursor in ("not a cursor", bad):
+            self.assertRaises(ValueError, multivid.find, u"query",
+                    cursor=cursor)
+
+class ResultCacheTest(MultividTestCase):
+
+    def setUp(self):
+        MultividTestCase.setUp(self)
+        self.searcher = FakeSearch("fake")
+        self.use(self.searcher)
+
+    def test_results_are_cached(self):
+        first = multivid.find(u"query")
+        second = multivid.find(u"query")
+
+        self.assertEqual(self.searcher.calls, 1)
+        self.assertEqual([r.id for r in second], [r.id for r in first])
+
+    def test_queries_differing_in_case_and_spacing_share_results(self):
+        multivid.find(u"Some  Query")
+        multivid.find(u" some query")
+        multivid.autocomplete(u"Some  Query")
+        multivid.autocomplete(u"some query ")
+
+        self.assertEqual(self.searcher.calls, 2)
+
+    def test_byte_string_queries_are_decoded(self):
+        # bottle hands us queries as UTF-8 byte strings
+        results = multivid.find("Caf\xc3\xa9")
+        multivid.find(u"caf\xe9")
+        suggestions = multivid.autocomplete("caf\xc3\xa9")
+
+        self.assertEqual(self.searcher.calls, 2)
+        self.assertEqual(results.failed, [])
+        self.assertEqual(suggestions[0].suggestion, u"caf\xe9")
+
+        # and bytes that aren't UTF-8 are replaced rather than failing
+        results = multivid.find("caf\xe9")
+        self.assertEqual(results.failed, [])
+
+    def test_failures_are_not_cached(self):
+        self.searcher.error = ValueError()
+        multivid.find(u"query")
+        self.searcher.error = None
+        results = multivid.find(u"query")
+
+        self.assertEqual(self.searcher.calls, 2)
+        self.assertEqual(results.failed, [])
+
+    def test_zero_ttls_disable_caching(self):
+        saved_ttls = multivid.RESULT_TTLS
+        multivid.RESULT_TTLS = {u"fake": 0}
+        try:
+            multivid.find(u"query")
+            multivid.find(u"query")
+        finally:
+            multivid.RESULT_TTLS = saved_ttls
+
+        self.assertEqual(self.searcher.calls, 2)
+
+class StaleResultTest(MultividTestCase):
+
+    def setUp(self):
+        MultividTestCase.setUp(self)
+        self.searcher = FakeSearch("fake")
+        self.use(self.searcher)
+
+        # results go stale almost straight away, but are kept for a while
+        self.saved_refresh = (multivid.RESULT_TTLS, multivid.RESULT_GRACE,
+                multivid.REFRESH_BUDGET)
+        multivid.RESULT_TTLS = {u"fake": 0.01}
+        multivid.RESULT_GRACE = 60
+
+    def tearDown(self):
+        self.wait_for_refreshes()
+        (multivid.RESULT_TTLS, multivid.RESULT_GRACE,
+                multivid.REFRESH_BUDGET) = self.saved_refresh
+        MultividTestCase.tearDown(self)
+
+    def wait_for_refreshes(self):
+        give_up = time.time() + 5
+        while multivid._refreshing and time.time() < give_up:
+            time.sleep(0.01)
+
+    def find_stale(self):
+        """Find results, then let them go stale."""
+
+        results = multivid.find(u"query")
+        time.sleep(0.02)
+        return results
+
+    def test_stale_results_are_served_while_refreshing(self):
+        first = self.find_stale()
+        second = multivid.find(u"query")
+        self.assertEqual([r.id for r in second], [r.id for r in first])
+
+        # the next caller gets the refreshed results
+        self.wait_for_refreshes()
+        third = multivid.find(u"query")
+        self.assertEqual(self.searcher.calls, 2)
+        self.assertEqual([r.id for r in third], [u"fake-2"])
+
+    def test_refreshes_in_progress_are_shared(self):
+        self.find_stale()
+        self.searcher.delay = 0.2
+        coalesced = multivid._refresh_counts["coalesced"]
+
+        for i in xrange(3):
+            multivid.find(u"query")
+        self.wait_for_refreshes()
+
+        self.assertEqual(self.searcher.calls, 2)
+        self.assertEqual(multivid._refresh_counts["coalesced"] - coalesced, 2)
+
+    def test_refreshes_are_throttled(self):
+        multivid.REFRESH_BUDGET = throttle.TokenBucket(0.001)
+        multivid.REFRESH_BUDGET.take()
+        throttled = multivid._refresh_counts["throttled"]
+
+        first = self.find_stale()
+        second = multivid.find(u"query")
+        self.wait_for_refreshes()
+
+        self.assertEqual(self.searcher.calls, 1)
+        self.assertEqual([r.id for r in second], [r.id for r in first])
+        self.assertEqual(multivid._refresh_counts["throttled"] - throttled, 1)
+
+    def test_failed_refreshes_keep_the_stale_results(self):
+        first = self.find_stale()
+        self.searcher.error = ValueError()
+        multivid.find(u"query")
+        self.wait_for_refreshes()
+
+        second = multivid.find(u"query")
+        self.assertEqual([r.id for r in second], [r.id for r in first])
+        self.assertEqual(second.failed, [])
+
+class ConfigureTest(MultividTestCase):
+
+    def configure(self, config):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "multivid.conf")
+            with open(path, "w") as f:
+                json.dump(config, f)
+            multivid.configure(path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_result_cache_bounds_that_are_not_given_are_kept(self):
+        self.use(FakeSearch("fake"))
+        max_bytes = multivid.RESULT_CACHE.max_bytes
+
+        self.configure({"result_cache": {"max_entries": 10}})
+        self.assertEqual(multivid.RESULT_CACHE.max_entries, 10)
+        self.assertEqual(multivid.RESULT_CACHE.max_bytes, max_bytes)
+
+        self.configure({"result_cache": {"max_bytes": 1024}})
+        self.assertEqual(multivid.RESULT_CACHE.max_entries, 10)
+        self.assertEqual(multivid.RESULT_CACHE.max_bytes, 1024)
+
+class BreakerTest(MultividTestCase):
+
+    def setUp(self):
+        MultividTestCase.setUp(self)
+        self.searcher = FakeSearch("up", urls=["http://up.example.invalid/"])
+        self.use(self.searcher)
+
+    def find_times(self, times, budget_ms=1000):
+        for i in xrange(times):
+            multivid.RESULT_CACHE.clear()
+            results = multivid.find(u"query", budget_ms=budget_ms)
+        return results
+
+    def state(self):
+        return multivid.BREAKERS[u"up"].state
+
+    def test_deadlines_do_not_open_breakers(self):
+        self.fail_sends(exceptions.Timeout("deadline passed"))
+        self.find_times(10)
+        self.assertEqual(self.state(), u"closed")
+
+    def test_late_searchers_do_not_open_breakers(self):
+        self.searcher.request_urls = []
+        self.searcher.delay = 0.1
+        self.find_times(6, budget_ms=10)
+        self.assertEqual(self.state(), u"closed")
+
+    def test_client_errors_do_not_open_breakers(self):
+        self.answer_sends(404)
+        results = self.find_times(10)
+
+        self.assertEqual(self.state(), u"closed")
+        self.assertEqual(results.failed, [u"up"])
+
+    def test_upstream_errors_open_breakers(self):
+        for error in (exceptions.ConnectionError("refused"), None):
+            if error is None:
+                self.answer_sends(503)
+            else:
+                self.fail_sends(error)
+            self.use(self.searcher)
+
+            results = self.find_times(6)
+            self.assertEqual(self.state(), u"open")
+            self.assertEqual(results.skipped, [u"up"])
+
+    def test_parse_errors_open_breakers(self):
+        self.searcher.error = ValueError("no <Items> element in payload")
+        self.find_times(5)
+        self.assertEqual(self.state(), u"open")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,694 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import json
+import unittest
+import xml.etree.cElementTree as ElementTree
+
+from requests import exceptions
+
+import arequests
+import containers
+import search
+
+HULU_TV = """<?xml version="1.0" encoding="UTF-8"?>
+<results>
+  <videos type="array">
+    <video>
+      <id>1001</id>
+      <title>Pilot</title>
+      <description>The first one.</description>
+      <season-number>1</season-number>
+      <episode-number>1</episode-number>
+      <rating>4.5</rating>
+      <duration>1320.5</duration>
+      <thumbnail-url>http://ib.huluim.com/video/1001?size=145x80</thumbnail-url>
+      <show>
+        <id>77</id>
+        <name>Some Show</name>
+        <canonical-name>some-show</canonical-name>
+        <description>A show.</description>
+        <user-star-rating>4.0</user-star-rating>
+        <seasons-count>2</seasons-count>
+        <episodes-count>20</episodes-count>
+      </show>
+    </video>
+    <video>
+      <id>1002</id>
+      <title>Second</title>
+      <description>The second one.</description>
+      <season-number>1</season-number>
+      <episode-number>2</episode-number>
+      <rating>3.5</rating>
+      <duration>1300</duration>
+      <thumbnail-url>http://ib.huluim.com/video/1002?size=145x80</thumbnail-url>
+      <show>
+        <id>77</id>
+        <name>Some Show</name>
+        <canonical-name>some-show</canonical-name>
+        <description>A show.</description>
+        <user-star-rating>4.0</user-star-rating>
+        <seasons-count>2</seasons-count>
+        <episodes-count>20</episodes-count>
+      </show>
+    </video>
+  </videos>
+</results>
+"""
+
+HULU_MOVIES = """<?xml version="1.0" encoding="UTF-8"?>
+<results>
+  <videos type="array">
+    <video>
+      <id>2001</id>
+      <title>A Movie</title>
+      <description>A film.</description>
+      <rating>4</rating>
+      <duration>5400.25</duration>
+      <thumbnail-url>http://ib.huluim.com/video/2001?size=145x80</thumbnail-url>
+    </video>
+  </videos>
+</results>
+"""
+
+AMAZON_PAGE = """<?xml version="1.0" ?>
+<ItemSearchResponse
+    xmlns="http://webservices.amazon.com/AWSECommerceService/2011-08-01">
+  <Items>
+    <Request><IsValid>True</IsValid></Request>
+    <TotalResults>2</TotalResults>
+    <Item>
+      <ASIN>B001</ASIN>
+      <DetailPageURL>http://www.amazon.com/dp/B001</DetailPageURL>
+      <LargeImage><URL>http://ecx.images-amazon.com/B001.jpg</URL></LargeImage>
+      <ItemAttributes>
+        <ProductGroup>Movie</ProductGroup>
+        <RunningTime Units="minutes">95</RunningTime>
+        <Title>A Movie</Title>
+      </ItemAttributes>
+    </Item>
+    <Item>
+      <ASIN>B002</ASIN>
+      <DetailPageURL>http://www.amazon.com/dp/B002</DetailPageURL>
+      <ItemAttributes>
+        <EpisodeSequence>3</EpisodeSequence>
+        <ProductGroup>TV Series Episode Video on Demand</ProductGroup>
+        <Title>Third Episode</Title>
+      </ItemAttributes>
+      <RelatedItems>
+        <RelatedItem>
+          <Item>
+            <ASIN>B100</ASIN>
+            <ItemAttributes>
+              <EpisodeSequence>2</EpisodeSequence>
+              <ProductGroup>TV Series Season Video on Demand</ProductGroup>
+              <Title>Some Show Season 2</Title>
+            </ItemAttributes>
+          </Item>
+        </RelatedItem>
+      </RelatedItems>
+    </Item>
+  </Items>
+</ItemSearchResponse>
+"""
+
+AMAZON_ERROR = """<?xml version="1.0" ?>
+<ItemSearchErrorResponse
+    xmlns="http://ecs.amazonaws.com/doc/2011-08-01/">
+  <Error><Code>RequestThrottled</Code><Message>Slow down.</Message></Error>
+</ItemSearchErrorResponse>
+"""
+
+AMAZON_ITEM = """
+    <Item>
+      <ASIN>%s</ASIN>
+      <DetailPageURL>http://www.amazon.com/dp/%s</DetailPageURL>
+      <ItemAttributes>
+        <ProductGroup>Movie</ProductGroup>
+        <Title>Movie %s</Title>
+      </ItemAttributes>
+    </Item>
+"""
+
+AMAZON_DETAILS = """<?xml version="1.0" ?>
+<ItemLookupResponse
+    xmlns="http://webservices.amazon.com/AWSECommerceService/2011-08-01">
+  <Items>
+    <Request><IsValid>True</IsValid></Request>
+    %s
+  </Items>
+</ItemLookupResponse>
+"""
+
+AMAZON_DETAILS_ITEM = """
+    <Item>
+      <ASIN>%s</ASIN>
+      <EditorialReviews>
+        <EditorialReview>
+          <Source>Product Description</Source>
+          <Content>%s</Content>
+        </EditorialReview>
+      </EditorialReviews>
+      <CustomerReviews><AverageRating>%s</AverageRating></CustomerReviews>
+    </Item>
+"""
+
+def amazon_page(asins):
+    """Build an ItemSearch response holding a movie for each ASIN."""
+
+    items = "".join(AMAZON_ITEM % (asin, asin, asin) for asin in asins)
+    head = AMAZON_PAGE.split("<Item>")[0]
+    return head + items + "</Items>\n</ItemSearchResponse>\n"
+
+def dicts(results):
+    return [r.to_dict() for r in results]
+
+class IterXMLTest(unittest.TestCase):
+
+    def test_yields_direct_children_without_namespaces(self):
+        ids = [search.Search.xml_text(item, "ASIN")
+                for item in search.Search.iter_xml(AMAZON_PAGE, "Items",
+                    "Item")]
+        self.assertEqual(ids, [u"B001", u"B002"])
+
+    def test_missing_container_raises_value_error(self):
+        items = search.Search.iter_xml(AMAZON_ERROR, "Items", "Item")
+        self.assertRaises(ValueError, list, items)
+
+    def test_malformed_payload_raises_parse_error(self):
+        items = search.Search.iter_xml("<Items><Item>", "Items", "Item")
+        self.assertRaises(ElementTree.ParseError, list, items)
+
+class ParseParityTest(unittest.TestCase):
+    """The streaming parsers must agree with the BeautifulSoup fallbacks."""
+
+    def test_hulu(self):
+        searcher = search.HuluSearch()
+        payloads = [HULU_TV, HULU_MOVIES]
+
+        results = searcher.parse(payloads)
+        self.assertEqual([r.type for r in results],
+                [u"series", u"episode", u"episode", u"movie"])
+        self.assertEqual(dicts(results), dicts(searcher.parse_soup(payloads)))
+
+    def test_amazon(self):
+        searcher = search.AmazonSearch(config_file=None)
+        payloads = [AMAZON_PAGE, AMAZON_PAGE]
+
+        results = searcher.parse(payloads)
+        self.assertEqual([r.id for r in results], [u"B001", u"B002"])
+        self.assertEqual(results[1].series_title, u"Some Show Season 2")
+        self.assertEqual(dicts(results), dicts(searcher.parse_soup(payloads)))
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        position = {"hulu": {"page": 2, "size": 20}, "netflix": {"start": 25}}
+        cursor = search.Search.encode_cursor(position)
+        self.assertEqual(search.Search.decode_cursor(cursor), position)
+
+    def test_malformed_cursors_raise_value_error(self):
+        for cursor in ("not a cursor", search.Search.encode_cursor([1, 2])):
+            self.assertRaises(ValueError, search.Search.decode_cursor, cursor)
+
+    def test_positions_are_checked(self):
+        hulu = search.HuluSearch()
+        amazon = search.AmazonSearch(config_file=None)
+        netflix = search.NetflixSearch(config_file=None)
+
+        self.assertEqual(hulu.check_position({"page": 2, "size": 20}),
+                {"page": 2, "size": 20})
+
+        bad = [
+            (hulu, {"page": 1, "size": 100000}),
+            (hulu, {"page": "1", "size": 20}),
+            (hulu, {"page": 0, "size": 20}),
+            (amazon, {"page": amazon.max_pages + 1}),
+            (netflix, {"start": -1}),
+            (netflix, {"start": True}),
+            (netflix, 25)
+        ]
+        for searcher, position in bad:
+            self.assertRaises(ValueError, searcher.check_position, position)
+
+class HuluImageTestCase(unittest.TestCase):
+    """
+    Answers Hulu's image probes from memory: URLs for sizes in self.sizes
+    exist, and the rest don't.
+    """
+
+    def setUp(self):
+        self.saved_send = arequests.send
+        arequests.send = self.send
+        search.HuluSearch.image_cache.clear()
+
+        self.sizes = set()
+        self.probed = []
+        self.delay = 0.0
+        self.error = None
+
+    def tearDown(self):
+        arequests.send = self.saved_send
+        search.HuluSearch.image_cache.clear()
+
+    def send(self, request, *args, **kwargs):
+        self.probed.append(request.url)
+        time.sleep(self.delay)
+        if self.error is not None:
+            return arequests.failed(request, self.error)
+
+        response = arequests.failed(request, None)
+        response.status_code = 404
+        if any(size in request.url for size in self.sizes):
+            response.status_code = 200
+
+        # requests re-quotes URLs, so a response's URL needn't be the one its
+        # request was built with
+        response.url = request.url.replace("?", "?re=quoted&")
+        return response
+
+def thumbnail(i):
+    return "http://ib.huluim.com/video/%d?size=145x80&img=1" % i
+
+class HuluImageTest(HuluImageTestCase):
+
+    def test_best_available_size_is_used(self):
+        self.sizes = {"384x288"}
+        best = search.HuluSearch.get_best_image_urls([thumbnail(1)])
+
+        self.assertEqual(best,
+                {thumbnail(1): thumbnail(1).replace("145x80", "384x288")})
+
+    def test_images_are_probed_in_one_batch(self):
+        self.sizes = {"512x288"}
+        urls = [thumbnail(i) for i in xrange(5)]
+        best = search.HuluSearch.get_best_image_urls(urls, concurrency=3)
+
+        self.assertEqual(len(self.probed), 10)
+        self.assertEqual(best, dict((url, url.replace("145x80", "512x288"))
+                for url in urls))
+
+    def test_thumbnails_are_kept_without_better_sizes(self):
+        best = search.HuluSearch.get_best_image_url(thumbnail(1))
+        self.assertEqual(best, thumbnail(1))
+
+class HuluImageCacheTest(HuluImageTestCase):
+
+    def test_found_images_are_cached(self):
+        self.sizes = {"512x288"}
+        search.HuluSearch.get_best_image_url(thumbnail(1))
+        search.HuluSearch.get_best_image_url(thumbnail(1))
+
+        self.assertEqual(len(self.probed), 2)
+        self.assertEqual(search.HuluSearch.image_cache.get(thumbnail(1)),
+                thumbnail(1).replace("145x80", "512x288"))
+
+    def test_missing_images_are_cached_as_themselves(self):
+        search.HuluSearch.get_best_image_url(thumbnail(1))
+        best = search.HuluSearch.get_best_image_url(thumbnail(1))
+
+        self.assertEqual(best, thumbnail(1))
+        self.assertEqual(len(self.probed), 2)
+        self.assertEqual(search.HuluSearch.image_cache.get(thumbnail(1)),
+                thumbnail(1))
+
+    def test_images_that_could_not_be_checked_are_not_cached(self):
+        self.error = exceptions.ConnectionError("connection refused")
+        best = search.HuluSearch.get_best_image_url(thumbnail(1))
+
+        self.assertEqual(best, thumbnail(1))
+        self.assertEqual(search.HuluSearch.image_cache.get(thumbnail(1)), None)
+
+    def test_cached_images_expire(self):
+        saved_ttl = search.HuluSearch.IMAGE_CACHE_TTL
+        search.HuluSearch.IMAGE_CACHE_TTL = -1
+        try:
+            search.HuluSearch.get_best_image_url(thumbnail(1))
+            search.HuluSearch.get_best_image_url(thumbnail(1))
+        finally:
+            search.HuluSearch.IMAGE_CACHE_TTL = saved_ttl
+
+        self.assertEqual(len(self.probed), 4)
+
+    def test_cache_survives_a_save_and_load(self):
+        self.sizes = {"384x288"}
+        search.HuluSearch.get_best_image_url(thumbnail(1))
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "images.json")
+            search.HuluSearch.save_image_cache(path)
+            search.HuluSearch.image_cache.clear()
+            search.HuluSearch.load_image_cache(path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(search.HuluSearch.image_cache.get(thumbnail(1)),
+                thumbnail(1).replace("145x80", "384x288"))
+
+    def test_corrupt_and_missing_files_are_ignored(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "images.json")
+            search.HuluSearch.load_image_cache(path)
+
+            with open(path, "w") as f:
+                f.write("{not json")
+            search.HuluSearch.load_image_cache(path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(search.HuluSearch.image_cache), 0)
+
+class HuluDeferredImageTest(HuluImageTestCase):
+
+    def test_lookups_in_progress_are_shared(self):
+        self.delay = 0.2
+        first = search.HuluSearch.resolve_image_urls([thumbnail(1)])
+        second = search.HuluSearch.resolve_image_urls([thumbnail(1)])
+
+        self.assertIs(first[thumbnail(1)], second[thumbnail(1)])
+        first[thumbnail(1)].join()
+        self.assertEqual(len(self.probed), 2)
+
+    def test_cached_images_are_not_looked_up(self):
+        search.HuluSearch.get_best_image_url(thumbnail(1))
+        self.assertEqual(search.HuluSearch.resolve_image_urls([thumbnail(1)]),
+                {})
+
+    def test_known_images_wait_for_lookups(self):
+        self.sizes = {"384x288"}
+        best = search.HuluSearch().get_known_image_urls([thumbnail(1)],
+                deadline=time.time() + 5)
+
+        self.assertEqual(best,
+                {thumbnail(1): thumbnail(1).replace("145x80", "384x288")})
+
+    def test_late_lookups_are_left_running(self):
+        self.sizes = {"384x288"}
+        self.delay = 0.3
+        best = search.HuluSearch().get_known_image_urls([thumbnail(1)],
+                deadline=time.time() + 0.05)
+        self.assertEqual(best, {thumbnail(1): thumbnail(1)})
+
+        # the lookup still finishes, for whoever asks next
+        search.HuluSearch.pending_images[thumbnail(1)].join()
+        self.assertEqual(search.HuluSearch.image_cache.get(thumbnail(1)),
+                thumbnail(1).replace("145x80", "384x288"))
+
+    def test_only_hulu_hosts_are_probed(self):
+        own = [
+            "http://ib.huluim.com/video/1?size=145x80",
+            "http://hulu.com:8080/a.jpg",
+            "HTTPS://WWW.HULU.COM/a.jpg"
+        ]
+        foreign = [
+            "http://evilhulu.com/a.jpg",
+            "http://huluim.com.example.org/a.jpg",
+            "ftp://hulu.com/a.jpg",
+            "not a url"
+        ]
+
+        for url in own:
+            self.assertTrue(search.HuluSearch.is_own_image(url), url)
+        for url in foreign:
+            self.assertFalse(search.HuluSearch.is_own_image(url), url)
+
+        best = search.HuluSearch().get_known_image_urls(foreign,
+                deadline=time.time() + 1)
+        self.assertEqual(best, dict((url, url) for url in foreign))
+        self.assertEqual(self.probed, [])
+
+class AmazonTestCase(unittest.TestCase):
+    """
+    Answers Amazon's requests from memory. For ItemSearch, self.pages maps
+    page numbers to the ASINs on them, and pages that aren't there fail. For
+    ItemLookup, self.details maps ASINs to their review and rating, and
+    lookups of ASINs in self.down fail.
+    """
+
+    def setUp(self):
+        self.saved_send = arequests.send
+        arequests.send = self.send
+        self.pages = {}
+        self.sent = []
+        self.details = {}
+        self.down = set()
+        self.lookups = []
+        search.AmazonSearch.detail_cache.clear()
+
+    def tearDown(self):
+        arequests.send = self.saved_send
+        search.AmazonSearch.detail_cache.clear()
+
+    def searcher(self, **kwargs):
+        searcher = search.AmazonSearch(config_file=None, **kwargs)
+        searcher._Search__config = {
+            "amazon": {"public_key": "public", "private_key": "private"}
+        }
+        return searcher
+
+    def send(self, request, *args, **kwargs):
+        if request.params["Operation"] == "ItemLookup":
+            return self.lookup(request)
+
+        page = request.params["ItemPage"]
+        self.sent.append(page)
+        if page not in self.pages:
+            return arequests.failed(request,
+                    exceptions.ConnectionError("refused"))
+
+        response = arequests.failed(request, None)
+        response.status_code = 200
+        response._content = amazon_page(self.pages[page])
+        return response
+
+    def lookup(self, request):
+        asins = request.params["ItemId"].split(",")
+        self.lookups.append(asins)
+        if any(asin in self.down for asin in asins):
+            return arequests.failed(request,
+                    exceptions.ConnectionError("refused"))
+
+        items = []
+        for asin in asins:
+            if asin in self.details:
+                review, rating = self.details[asin]
+                items.append(AMAZON_DETAILS_ITEM % (asin, review, rating))
+
+        response = arequests.failed(request, None)
+        response.status_code = 200
+        response._content = AMAZON_DETAILS % "".join(items)
+        return response
+
+def asins(first, count):
+    return [u"B%03d" % i for i in xrange(first, first + count)]
+
+class AmazonPageTest(AmazonTestCase):
+
+    def test_each_page_is_signed(self):
+        requests = self.searcher().build_requests(u"query", limit=25)
+
+        self.assertEqual([r.params["ItemPage"] for r in requests], [1, 2, 3])
+        signatures = set(r.params["Signature"] for r in requests)
+        self.assertEqual(len(signatures), 3)
+
+    def test_unicode_queries_are_signed(self):
+        request = self.searcher().build_page_request(u"caf\xe9", 1)
+        self.assertEqual(request.params["Keywords"], u"caf\xe9")
+        self.assertTrue("Signature" in request.params)
+
+    def test_pages_stop_at_the_last_one(self):
+        searcher = self.searcher()
+        requests = searcher.build_requests(u"query", position={"page": 10})
+
+        self.assertEqual([r.params["ItemPage"] for r in requests], [10])
+        self.assertEqual(searcher.next_position([None] * 10,
+                position={"page": 10}), None)
+
+    def test_full_pages_have_a_next_page(self):
+        self.pages = {1: asins(0, 10), 2: asins(10, 10)}
+        results = self.searcher().find(u"query")
+
+        self.assertEqual([r.id for r in results], asins(0, 20))
+        self.assertEqual(search.Search.decode_cursor(results.cursor),
+                {"page": 3})
+
+    def test_short_pages_are_the_last(self):
+        self.pages = {1: asins(0, 10), 2: asins(10, 3)}
+        results = self.searcher().find(u"query")
+
+        self.assertEqual(len(results), 13)
+        self.assertEqual(results.cursor, None)
+
+    def test_adaptive_searches_only_ask_for_later_pages_after_a_full_one(self):
+        self.pages = {1: asins(0, 10), 2: asins(5, 10)}
+        results = self.searcher(adaptive_pages=True).find(u"query")
+
+        self.assertEqual(self.sent, [1, 2])
+        self.assertEqual([r.id for r in results], asins(0, 15))
+
+    def test_adaptive_searches_stop_after_a_short_page(self):
+        self.pages = {1: asins(0, 4), 2: asins(4, 10)}
+        results = self.searcher(adaptive_pages=True).find(u"query")
+
+        self.assertEqual(self.sent, [1])
+        self.assertEqual(len(results), 4)
+
+    def test_later_pages_that_fail_are_skipped(self):
+        self.pages = {1: asins(0, 10)}
+        results = self.searcher(adaptive_pages=True).find(u"query", limit=30)
+
+        self.assertEqual(sorted(self.sent), [1, 2, 3])
+        self.assertEqual([r.id for r in results], asins(0, 10))
+
+class AmazonDetailTest(AmazonTestCase):
+
+    def test_results_are_enriched(self):
+        self.pages = {1: asins(0, 2)}
+        self.details = {
+            u"B000": ("&lt;b&gt;A&lt;/b&gt; film. ", "4.0"),
+            u"B001": ("Another film.", "2.5")
+        }
+        results = self.searcher(enrich=True).find(u"query", limit=10)
+
+        self.assertEqual([r.description for r in results],
+                [u"A film.", u"Another film."])
+        self.assertEqual([r.rating_fraction for r in results], [0.8, 0.5])
+
+    def test_results_are_only_enriched_when_asked(self):
+        self.pages = {1: asins(0, 2)}
+        results = self.searcher().find(u"query", limit=10)
+
+        self.assertEqual(self.lookups, [])
+        self.assertEqual(results[0].description, None)
+
+    def test_lookups_are_batched_and_cached(self):
+        searcher = self.searcher(enrich=True)
+        ids = asins(0, 25)
+        self.details = dict((asin, ("Film.", "3.0")) for asin in ids)
+
+        searcher.get_details(ids)
+        details = searcher.get_details(ids)
+
+        self.assertEqual(sorted(len(batch) for batch in self.lookups),
+                [5, 10, 10])
+        self.assertEqual(details[u"B024"],
+                {"description": u"Film.", "rating_fraction": 0.6})
+
+    def test_failed_lookups_leave_results_alone(self):
+        self.pages = {1: asins(0, 2)}
+        self.down = {u"B000"}
+        results = self.searcher(enrich=True).find(u"query", limit=10)
+
+        self.assertEqual([r.id for r in results], asins(0, 2))
+        self.assertEqual(results[0].description, None)
+        self.assertEqual(len(search.AmazonSearch.detail_cache), 0)
+
+class NetflixDetailTest(unittest.TestCase):
+    """
+    Answers Netflix's bulk title requests from memory: self.runtimes maps
+    title ids to their durations, and batches whose first id is in self.down
+    fail.
+    """
+
+    def setUp(self):
+        self.saved_send = arequests.send
+        arequests.send = self.send
+        search.NetflixSearch.detail_cache.clear()
+
+        self.runtimes = {}
+        self.down = set()
+        self.batches = []
+
+        self.searcher = search.NetflixSearch(config_file=None)
+        self.searcher._Search__config = {
+            "netflix": {"public_key": "public", "private_key": "private"}
+        }
+
+    def tearDown(self):
+        arequests.send = self.saved_send
+        search.NetflixSearch.detail_cache.clear()
+
+    def send(self, request, *args, **kwargs):
+        ids = request.data["title_refs"].split(",")
+        self.batches.append(ids)
+        if ids[0] in self.down:
+            return arequests.failed(request,
+                    exceptions.ConnectionError("refused"))
+
+        response = arequests.failed(request, None)
+        response.status_code = 200
+        response._content = json.dumps({"catalog": [
+            {"id": i, "runtime": self.runtimes[i]}
+            for i in ids if i in self.runtimes]})
+        return response
+
+    def movies(self, count):
+        results = []
+        for i in xrange(count):
+            r = containers.MovieResult(u"netflix")
+            r.id = u"movies/%d" % i
+            results.append(r)
+        return results
+
+    def test_durations_are_looked_up_in_batches(self):
+        self.runtimes = dict((u"movies/%d" % i, 60 * i) for i in xrange(120))
+        results = self.searcher.finish(self.movies(120))
+
+        self.assertEqual(sorted(len(batch) for batch in self.batches),
+                [20, 50, 50])
+        self.assertEqual([r.duration_seconds for r in results],
+                [60 * i for i in xrange(120)])
+
+    def test_known_durations_are_kept(self):
+        results = self.movies(2)
+        results[0].duration_seconds = 5
+        self.runtimes = {u"movies/0": 60, u"movies/1": 60}
+        self.searcher.finish(results)
+
+        self.assertEqual(self.batches, [[u"movies/1"]])
+        self.assertEqual([r.duration_seconds for r in results], [5, 60])
+
+    def test_details_are_cached(self):
+        self.runtimes = {u"movies/0": 60}
+        self.searcher.get_details([u"movies/0", u"movies/1"])
+        details = self.searcher.get_details([u"movies/0", u"movies/1"])
+
+        # titles the API doesn't know are cached too
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(details, {
+            u"movies/0": {"duration_seconds": 60},
+            u"movies/1": {}
+        })
+
+    def test_failed_batches_are_left_out(self):
+        self.runtimes = dict((u"movies/%d" % i, 60) for i in xrange(60))
+        self.down = {u"movies/0"}
+        ids = [u"movies/%d" % i for i in xrange(60)]
+        details = self.searcher.get_details(ids)
+
+        self.assertEqual(sorted(details), sorted(ids[50:]))
+
+        # and are asked about again next time
+        self.down = set()
+        details = self.searcher.get_details(ids)
+        self.assertEqual(len(details), 60)
+        self.assertEqual(len(self.batches), 3)
+
+    def test_unicode_queries_are_signed(self):
+        request = self.searcher.build_requests(u"caf\xe9")[0]
+        self.assertEqual(request.params["term"], u"caf\xe9")
+        self.assertTrue("oauth_signature" in request.params)
+
+    def test_lookups_are_skipped_without_enough_time(self):
+        results = self.searcher.finish(self.movies(1),
+                deadline=time.time() + 0.01)
+
+        self.assertEqual(self.batches, [])
+        self.assertEqual(results[0].duration_seconds, None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import time
+import unittest
+
+import throttle
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_bursts_then_waits(self):
+        bucket = throttle.TokenBucket(10, burst=2)
+
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+
+        # the third token is reserved from about a tenth of a second from now
+        wait = bucket.reserve()
+        self.assertTrue(0.05 < wait <= 0.1, wait)
+
+    def test_reserve_gives_up_past_the_deadline(self):
+        bucket = throttle.TokenBucket(1)
+        bucket.reserve()
+
+        self.assertEqual(bucket.reserve(deadline=time.time() + 0.1), None)
+
+    def test_take_never_waits(self):
+        bucket = throttle.TokenBucket(1)
+
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_unlimited_keys_are_never_held_up(self):
+        limiter = throttle.RateLimiter()
+        self.assertTrue(all(limiter.acquire("free") for i in xrange(100)))
+
+    def test_rejections_are_counted(self):
+        limiter = throttle.RateLimiter()
+        limiter.limit("slow", 1)
+
+        self.assertTrue(limiter.acquire("slow"))
+        self.assertFalse(limiter.acquire("slow", deadline=time.time()))
+        self.assertEqual(limiter.stats()["slow"]["rejections"], 1)
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def test_failures_halve_the_limit_once_per_overload(self):
+        limit = throttle.AdaptiveLimit(initial=8)
+
+        # both requests were in flight when the first failed
+        first = limit.acquire()
+        second = limit.acquire()
+        limit.release(first, False)
+        limit.release(second, False)
+
+        self.assertEqual(limit.limit, 4)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_healthy_requests_grow_the_limit(self):
+        limit = throttle.AdaptiveLimit(initial=2, maximum=3)
+        for i in xrange(20):
+            limit.release(limit.acquire(), True)
+
+        self.assertEqual(limit.limit, 3)
+
+    def test_acquire_gives_up_past_the_deadline(self):
+        limit = throttle.AdaptiveLimit(initial=1)
+        limit.acquire()
+
+        self.assertEqual(limit.acquire(deadline=time.time() + 0.05), None)
+
+    def test_limiter_keeps_a_limit_per_key(self):
+        limiter = throttle.AdaptiveLimiter(initial=2)
+
+        self.assertIs(limiter.get("a"), limiter.get("a"))
+        self.assertIsNot(limiter.get("a"), limiter.get("b"))
+        self.assertEqual(limiter.stats()["a"], {"limit": 2, "in_flight": 0})
+
+if __name__ == "__main__":
+    unittest.main()
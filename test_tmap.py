@@ -0,0 +1,293 @@
+import itertools
+import threading
+import time
+import unittest
+
+import tmap
+
+class Boom(Exception):
+    pass
+
+def boom(item):
+    raise Boom(item)
+
+def square(item):
+    return item * item
+
+class MapTest(unittest.TestCase):
+
+    def test_results_keep_their_order(self):
+        results = tmap.map(lambda x: x * 2, range(20), num_threads=4)
+        self.assertEqual(results, [x * 2 for x in range(20)])
+
+    def test_raising_function_does_not_hang(self):
+        # a raising function used to kill its worker before it marked its item
+        # as done, so map waited on the work queue forever
+        raised = []
+        def run():
+            try:
+                tmap.map(boom, range(5), num_threads=2)
+            except Boom as e:
+                raised.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive(), "tmap.map hung")
+        self.assertEqual(len(raised), 1)
+
+class OutcomeTest(unittest.TestCase):
+
+    def test_of_captures_the_value(self):
+        outcome = tmap.Outcome.of(lambda: 42)
+        self.assertTrue(outcome.ok)
+        self.assertEqual(outcome.get(), 42)
+
+    def test_of_captures_the_exception(self):
+        outcome = tmap.Outcome.of(boom, 1)
+        self.assertFalse(outcome.ok)
+        self.assertIsInstance(outcome.exception, Boom)
+        self.assertRaises(Boom, outcome.get)
+
+    def test_cancelled_is_not_ok(self):
+        self.assertRaises(tmap.Cancelled, tmap.Outcome(cancelled=True).get)
+        self.assertFalse(tmap.Outcome(cancelled=True).ok)
+
+    def test_timed_out_is_not_ok(self):
+        self.assertRaises(tmap.TimedOut, tmap.Outcome(timed_out=True).get)
+        self.assertFalse(tmap.Outcome(timed_out=True).ok)
+
+class PoolMapTest(unittest.TestCase):
+
+    def test_map_keeps_order(self):
+        pool = tmap.Pool(4)
+        self.assertEqual(pool.map(lambda x: x + 1, range(10)), range(1, 11))
+
+    def test_map_reraises(self):
+        self.assertRaises(Boom, tmap.Pool(2).map, boom, range(3))
+
+    def test_nested_maps_do_not_deadlock(self):
+        # the outer map holds the only thread, so the inner one has to run
+        # its items in the calling thread
+        pool = tmap.Pool(1)
+        results = pool.map(lambda x: sum(pool.map(lambda y: y, range(x))),
+                range(4))
+        self.assertEqual(results, [0, 0, 1, 3])
+
+    def test_shared_pool_is_shared(self):
+        self.assertIs(tmap.shared_pool(), tmap.shared_pool())
+
+class StreamingTest(unittest.TestCase):
+
+    def test_imap_unordered_yields_in_completion_order(self):
+        pool = tmap.Pool(2)
+        def run(delay):
+            time.sleep(delay)
+            return delay
+
+        results = list(pool.imap_unordered(run, [0.2, 0.0]))
+        self.assertEqual(results, [(1, 0.0), (0, 0.2)])
+
+    def test_imap_unordered_yields_every_index(self):
+        pool = tmap.Pool(4)
+        results = dict(pool.imap_unordered(lambda x: x * x, xrange(10)))
+        self.assertEqual(results, dict((i, i * i) for i in xrange(10)))
+
+    def test_imap_keeps_order(self):
+        pool = tmap.Pool(4)
+        self.assertEqual(list(pool.imap(lambda x: -x, range(5))),
+                [0, -1, -2, -3, -4])
+
+class BackpressureTest(unittest.TestCase):
+
+    def counting(self, iterable):
+        """Wrap an iterable, counting how many items have been pulled."""
+
+        self.pulled = 0
+        for item in iterable:
+            self.pulled += 1
+            yield item
+
+    def test_imap_pulls_lazily_from_unbounded_iterables(self):
+        pool = tmap.Pool(2)
+        results = pool.imap(square, self.counting(itertools.count()), limit=3)
+
+        self.assertEqual(list(itertools.islice(results, 5)),
+                [0, 1, 4, 9, 16])
+        self.assertTrue(self.pulled <= 5 + 3, self.pulled)
+
+    def test_imap_unordered_keeps_limit_in_flight(self):
+        pool = tmap.Pool(8)
+        lock = threading.Lock()
+        state = {"running": 0, "most": 0}
+        def run(item):
+            with lock:
+                state["running"] += 1
+                state["most"] = max(state["most"], state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+            return item
+
+        results = list(pool.imap_unordered(run, xrange(20), limit=3))
+        self.assertEqual(sorted(r for i, r in results), range(20))
+        self.assertTrue(state["most"] <= 3, state["most"])
+
+    def test_closing_imap_unordered_cancels_unstarted_items(self):
+        pool = tmap.Pool(1)
+        ran = []
+        def run(item):
+            ran.append(item)
+            time.sleep(0.01)
+            return item
+
+        results = pool.imap_unordered(run, self.counting(xrange(100)),
+                limit=4)
+        results.next()
+        results.close()
+        time.sleep(0.1)
+
+        self.assertTrue(self.pulled <= 5, self.pulled)
+        self.assertTrue(len(ran) <= 5, ran)
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        # a single thread makes the order tasks are run in observable
+        self.pool = tmap.Pool(1)
+
+    def block(self):
+        """
+        Occupy the pool's only thread until the returned event is set, so
+        tasks submitted in the meantime queue up behind it.
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        self.pool.submit(blocker)
+        self.assertTrue(started.wait(5))
+        return release
+
+    def test_higher_priority_classes_run_first(self):
+        release = self.block()
+
+        order = []
+        tasks = []
+        for priority in (tmap.BACKGROUND, tmap.NORMAL, tmap.INTERACTIVE):
+            with tmap.scheduling(priority):
+                tasks.append(self.pool.submit(order.append, priority))
+
+        release.set()
+        for task in tasks:
+            self.assertTrue(task.wait(5))
+
+        self.assertEqual(order,
+                [tmap.INTERACTIVE, tmap.NORMAL, tmap.BACKGROUND])
+
+    def test_groups_take_turns(self):
+        release = self.block()
+
+        order = []
+        tasks = []
+        for group in ("a", "b"):
+            with tmap.scheduling(group=group):
+                for i in xrange(3):
+                    tasks.append(self.pool.submit(order.append, group))
+
+        release.set()
+        for task in tasks:
+            self.assertTrue(task.wait(5))
+
+        self.assertEqual(order, ["a", "b", "a", "b", "a", "b"])
+
+    def test_tasks_inherit_scheduling(self):
+        with tmap.scheduling(tmap.BACKGROUND, group="a"):
+            task = self.pool.submit(
+                    lambda: self.pool.submit(tmap.current_scheduling).join())
+        self.assertEqual(task.join(), (tmap.BACKGROUND, "a"))
+
+    def test_submit_after_gets_the_outcomes(self):
+        first = self.pool.submit(lambda: 1)
+        second = self.pool.submit(boom, 2)
+
+        after = self.pool.submit_after([first, second],
+                lambda outcomes: [o.ok for o in outcomes])
+        self.assertEqual(after.join(), [True, False])
+
+    def test_fail_fast_cancels_unstarted_items(self):
+        release = self.block()
+
+        def run(item):
+            if item == 0:
+                raise Boom(item)
+            return item
+
+        # the outcomes are only waited on once the items are queued
+        outcomes = []
+        thread = threading.Thread(target=lambda: outcomes.extend(
+                self.pool.map_outcomes(run, range(4), fail_fast=True)))
+        thread.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join(5)
+
+        self.assertIsInstance(outcomes[0].exception, Boom)
+        self.assertTrue(all(o.cancelled for o in outcomes[1:]))
+
+    def test_deadline_times_out_unfinished_items(self):
+        release = self.block()
+        try:
+            outcomes = self.pool.map_outcomes(lambda x: x, range(2),
+                    deadline=time.time() + 0.05)
+        finally:
+            release.set()
+
+        self.assertTrue(all(o.timed_out for o in outcomes))
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_calls_run_in_order_of_their_time(self):
+        scheduler = tmap.Scheduler()
+        order = []
+        later = scheduler.call_later(0.1, order.append, "later")
+        sooner = scheduler.call_later(0.0, order.append, "sooner")
+
+        self.assertTrue(later.wait(5) and sooner.wait(5))
+        self.assertEqual(order, ["sooner", "later"])
+
+    def test_cancelled_calls_do_not_run(self):
+        scheduler = tmap.Scheduler()
+        ran = []
+        task = scheduler.call_later(0.05, ran.append, 1)
+
+        self.assertTrue(task.cancel())
+        time.sleep(0.1)
+        self.assertEqual(ran, [])
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = tmap.ProcessPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_map_keeps_order(self):
+        self.assertEqual(self.pool.map(square, range(10)),
+                [x * x for x in range(10)])
+
+    def test_map_in_chunks(self):
+        self.assertEqual(self.pool.map(square, range(7), limit=3),
+                [x * x for x in range(7)])
+
+    def test_map_of_nothing(self):
+        self.assertEqual(self.pool.map(square, []), [])
+
+if __name__ == "__main__":
+    unittest.main()
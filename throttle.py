@@ -0,0 +1,219 @@
+import collections
+import threading
+import time
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average, with bursts of up to burst
+    events at once. Tokens are handed out in the order they're asked for, so
+    callers that have to wait queue up fairly.
+    """
+
+    def __init__(self, rate, burst=1):
+        assert rate > 0
+        assert burst >= 1
+
+        self.rate = float(rate)
+        self.burst = burst
+
+        self.__tokens = float(burst)
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def reserve(self, deadline=None):
+        """
+        Take a token, returning how many seconds the caller must wait before
+        using it. If that wait would pass the deadline (an absolute
+        time.time() value), no token is taken and None is returned.
+        """
+
+        with self.__lock:
+            now = self.__refill()
+
+            wait = 0.0
+            if self.__tokens < 1:
+                wait = (1 - self.__tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return None
+
+            # going negative reserves a token from the future
+            self.__tokens -= 1
+            return wait
+
+    def take(self):
+        """Take a token if one is available right now. Returns whether it was."""
+
+        with self.__lock:
+            self.__refill()
+            if self.__tokens < 1:
+                return False
+
+            self.__tokens -= 1
+            return True
+
+    def __refill(self):
+        """
+        Add the tokens that have accrued since we last looked, returning the
+        current time. Must hold the lock.
+        """
+
+        now = time.time()
+        self.__tokens = min(self.__tokens + (now - self.__last) * self.rate,
+                self.burst)
+        self.__last = now
+        return now
+
+class RateLimiter(object):
+    """
+    A token bucket for each of a set of keys, such as hosts, with counters
+    for how long callers spent waiting on them. Keys without a limit are
+    never held up.
+    """
+
+    def __init__(self):
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+        # per-key counters
+        self.__waits = collections.defaultdict(int)
+        self.__waited_seconds = collections.defaultdict(float)
+        self.__rejections = collections.defaultdict(int)
+
+    def limit(self, key, rate, burst=1):
+        """Limit key to rate events per second, in bursts of up to burst."""
+
+        with self.__lock:
+            self.__buckets[key] = TokenBucket(rate, burst)
+
+    def acquire(self, key, deadline=None):
+        """
+        Wait until key may be used. Returns True once it may, or False straight
+        away if the wait would pass the deadline.
+        """
+
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+        if bucket is None:
+            return True
+
+        wait = bucket.reserve(deadline)
+        if wait is None:
+            with self.__lock:
+                self.__rejections[key] += 1
+            return False
+
+        if wait > 0:
+            with self.__lock:
+                self.__waits[key] += 1
+                self.__waited_seconds[key] += wait
+            time.sleep(wait)
+
+        return True
+
+    def stats(self):
+        """Return the counters for every limited key as a dict."""
+
+        with self.__lock:
+            return dict((key, {
+                "rate": bucket.rate,
+                "burst": bucket.burst,
+                "waits": self.__waits[key],
+                "waited_seconds": self.__waited_seconds[key],
+                "rejections": self.__rejections[key]
+            }) for key, bucket in self.__buckets.items())
+
+class AdaptiveLimit(object):
+    """
+    A concurrency limit that adjusts itself to what an upstream can handle.
+    It grows by about one for every limit's worth of healthy requests, and
+    halves when a request fails in a way that suggests overload (additive
+    increase, multiplicative decrease). Requests that succeed but take more
+    than latency_tolerance times the fastest latency seen hold it steady.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, latency_tolerance=3.0):
+        assert 1 <= minimum <= initial <= maximum
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+
+        self.limit = float(initial)
+        self.in_flight = 0
+
+        # the fastest healthy request seen, and when we last backed off
+        self.__best_latency = None
+        self.__last_decrease = 0.0
+
+        self.__condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """
+        Wait for a free slot and take it, returning the time it was taken. If
+        no slot frees up before the deadline, returns None instead.
+        """
+
+        with self.__condition:
+            while self.in_flight >= int(self.limit):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                self.__condition.wait(remaining)
+
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, healthy):
+        """
+        Give back a slot taken at started, adjusting the limit based on whether
+        the request it was used for went well.
+        """
+
+        with self.__condition:
+            self.in_flight -= 1
+            now = time.time()
+            latency = now - started
+
+            if not healthy:
+                # requests that were already in flight when we last backed off
+                # are part of the same overload, so only back off once for them
+                if started > self.__last_decrease:
+                    self.limit = max(self.limit / 2, self.minimum)
+                    self.__last_decrease = now
+            elif (self.__best_latency is None or
+                    latency <= self.__best_latency * self.latency_tolerance):
+                self.__best_latency = min(latency,
+                        self.__best_latency or latency)
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+            self.__condition.notify_all()
+
+class AdaptiveLimiter(object):
+    """An AdaptiveLimit for each of a set of keys, such as hosts."""
+
+    def __init__(self, **limit_kwargs):
+        # passed to every AdaptiveLimit that's created
+        self.limit_kwargs = limit_kwargs
+
+        self.__limits = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """Return the limit for key, creating it if needed."""
+
+        with self.__lock:
+            if key not in self.__limits:
+                self.__limits[key] = AdaptiveLimit(**self.limit_kwargs)
+            return self.__limits[key]
+
+    def stats(self):
+        """Return the current limit and load of every key as a dict."""
+
+        with self.__lock:
+            return dict((key, {
+                "limit": int(limit.limit),
+                "in_flight": limit.in_flight
+            }) for key, limit in self.__limits.items())
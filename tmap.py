@@ -1,6 +1,110 @@
+import collections
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import sys
 import threading
+import time
 import Queue as queue
 
+# number of threads in the shared pool when none is specified. this is the cap
+# on how much work the whole process runs at once, so set it before first use.
+DEFAULT_POOL_SIZE = 16
+
+# scheduling priority classes. queued tasks of a lower class always run first.
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# the priority class and fairness group of the work the current thread is doing
+_local = threading.local()
+
+def current_scheduling():
+    """Return the (priority, group) tuple the current thread is running with."""
+
+    return getattr(_local, "scheduling", (NORMAL, None))
+
+@contextlib.contextmanager
+def scheduling(priority=None, group=None):
+    """
+    Run the enclosed block with the given priority class and fairness group.
+    Tasks submitted from the block, and any tasks they submit in turn, are
+    queued with them. Pools take turns between the tasks of different groups,
+    so one user's large request can't starve everyone else's. Values that
+    aren't given are inherited from the enclosing block, and a block outside
+    of any group starts a new one.
+    """
+
+    old_priority, old_group = current_scheduling()
+
+    if priority is None:
+        priority = old_priority
+    if group is None:
+        group = old_group if old_group is not None else object()
+
+    _local.scheduling = (priority, group)
+    try:
+        yield
+    finally:
+        _local.scheduling = (old_priority, old_group)
+
+class Cancelled(Exception):
+    """Raised when the result of a task that was cancelled is requested."""
+    pass
+
+class TimedOut(Exception):
+    """Raised when the result of a task that ran out of time is requested."""
+    pass
+
+class Outcome(object):
+    """
+    What became of a single mapped item: either the value its function
+    returned or the exception it raised, along with how long it ran for.
+    """
+
+    def __init__(self, value=None, exc_info=None, elapsed=0.0,
+            cancelled=False, timed_out=False):
+        self.value = value
+        self.exc_info = exc_info
+        self.elapsed = elapsed
+        self.cancelled = cancelled
+
+        # whether the item was still unfinished when its deadline passed
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return (self.exc_info is None and not self.cancelled and
+                not self.timed_out)
+
+    @property
+    def exception(self):
+        return self.exc_info[1] if self.exc_info is not None else None
+
+    def get(self):
+        """Return the value, or re-raise the exception that was captured."""
+
+        if self.cancelled:
+            raise Cancelled()
+        if self.timed_out:
+            raise TimedOut()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    @staticmethod
+    def of(function, *args, **kwargs):
+        """Call function with args and capture what happened as an Outcome."""
+
+        start = time.time()
+        try:
+            return Outcome(function(*args, **kwargs),
+                    elapsed=time.time() - start)
+        except Exception:
+            return Outcome(exc_info=sys.exc_info(),
+                    elapsed=time.time() - start)
+
 def worker(function, work_queue, result_queue):
     """
     Worker thread that consumes from and produces to two Queues. Each item
@@ -9,15 +113,19 @@ def worker(function, work_queue, result_queue):
     and item. This ensures that ordering is preserved when work is done
     asynchronously if a PriorityQueue is used. If ordering isn't desired,
     simply use normal queues with fake indexes. The work queue is assumed to be
-    full at the time the worker thread is started.
+    full at the time the worker thread is started. Results are wrapped in
+    Outcome objects so a raising function can't kill the worker before it
+    marks its item as done.
     """
 
     # keep getting work until there's no more to be had
     while 1:
         try:
             index, item = work_queue.get_nowait()
-            result_queue.put_nowait((index, function(item)))
-            work_queue.task_done()
+            try:
+                result_queue.put_nowait((index, Outcome.of(function, item)))
+            finally:
+                work_queue.task_done()
         except queue.Empty:
             # stop working when all the work has been processed
             return
@@ -28,7 +136,9 @@ def worker(function, work_queue, result_queue):
 def map(function, sequence, num_threads=2):
     """
     Map a function onto a sequence in parallel. Blocks until results are
-    ready, and returns them in the order of the original sequence.
+    ready, and returns them in the order of the original sequence. If any
+    item raised an exception, the first one is re-raised once all the work
+    is done.
     """
 
     work_queue = queue.Queue(len(sequence))
@@ -59,10 +169,500 @@ def map(function, sequence, num_threads=2):
     assert result_queue.full()
 
     # return the results in the original order from the result queue
-    results = []
+    outcomes = []
     while not result_queue.empty():
-        index, result = result_queue.get_nowait()
-        results.append(result)
+        index, outcome = result_queue.get_nowait()
+        outcomes.append(outcome)
 
     assert result_queue.empty()
+    return [o.get() for o in outcomes]
+
+class Task(object):
+    """
+    A single call of a function that may be run by a pool thread or by
+    whoever is waiting on it, whichever claims it first. Once run, the task
+    holds either the function's return value or the exception it raised.
+    """
+
+    def __init__(self, function, args=(), kwargs=None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+
+        self.value = None
+        self.exc_info = None
+        self.cancelled = False
+
+        # run with the same scheduling as whoever created the task
+        self.scheduling = current_scheduling()
+
+        # when the function started and stopped running
+        self.started = None
+        self.finished = None
+
+        self.__claimed = False
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+        self.__done = threading.Event()
+
+    def claim(self):
+        """
+        Atomically mark the task as taken. Returns True if the caller is now
+        responsible for running it, False if someone else already is.
+        """
+
+        with self.__lock:
+            if self.__claimed:
+                return False
+            self.__claimed = True
+            return True
+
+    def run(self):
+        """Run the function and store its result. Must be claimed first."""
+
+        self.started = time.time()
+        old_scheduling = current_scheduling()
+        _local.scheduling = self.scheduling
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            _local.scheduling = old_scheduling
+            self.finished = time.time()
+            self.__finish()
+
+    def cancel(self):
+        """
+        Prevent the task from running if nobody has started it yet. Returns
+        True if the task was cancelled, False if it's already running or done.
+        """
+
+        if not self.claim():
+            return False
+
+        self.cancelled = True
+        self.__finish()
+        return True
+
+    def __finish(self):
+        """Mark the task as done and notify anyone who asked to be told."""
+
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the task to finish. Returns whether it did."""
+
+        return self.__done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with this task once it finishes, from whichever thread
+        ran it. If the task is already done, callback is called immediately.
+        """
+
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def join(self):
+        """
+        Wait for the task to finish and return its result, re-raising any
+        exception it raised. If no thread has picked the task up yet, it is
+        run in the calling thread instead so that nested maps never wait on
+        a pool that is busy running their parents.
+        """
+
+        if self.claim():
+            self.run()
+
+        self.__done.wait()
+        return self.outcome().get()
+
+    def outcome(self):
+        """Return an Outcome describing the finished task."""
+
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = self.finished - self.started
+
+        return Outcome(self.value, self.exc_info, elapsed, self.cancelled)
+
+def outcomes(tasks, deadline=None):
+    """
+    Wait for some tasks to finish and return their Outcomes in order. Tasks
+    that no thread has taken yet are run in this one. If a deadline (an
+    absolute time.time() value) is given, this returns once it passes, and
+    tasks that haven't finished by then are marked as timed out and left to
+    finish in the background.
+    """
+
+    results = []
+    for task in tasks:
+        if deadline is None:
+            if task.claim():
+                task.run()
+            task.wait()
+            results.append(task.outcome())
+            continue
+
+        # work is never run in this thread when there's a deadline, since that
+        # would block us past it. work that nobody got to or finished in time
+        # is given up on instead.
+        if task.wait(max(deadline - time.time(), 0)):
+            results.append(task.outcome())
+        else:
+            task.cancel()
+
+            elapsed = 0.0
+            if task.started is not None:
+                elapsed = time.time() - task.started
+            results.append(Outcome(elapsed=elapsed, timed_out=True))
+
     return results
+
+class Pool(object):
+    """
+    A long-lived set of worker threads that runs submitted tasks. Threads are
+    started on first use and live for the rest of the process, so mapping
+    over a pool costs no thread creation.
+
+    Queued tasks are run by priority class first, then fairly between groups
+    (see scheduling): each group's next task is placed one round after its
+    previous one, so groups take turns instead of queueing behind each other.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        assert size > 0
+        self.size = size
+
+        # holds (priority, round, sequence number, task) tuples
+        self.__queue = queue.PriorityQueue()
+        self.__sequence = itertools.count()
+
+        # the round of the most recently started task, and the last round and
+        # number of queued tasks of every group with tasks in the queue
+        self.__round = 0
+        self.__groups = {}
+
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def __start(self):
+        """Start the worker threads if they haven't been already."""
+
+        with self.__lock:
+            while len(self.__threads) < self.size:
+                thread = threading.Thread(target=self.__work)
+                thread.daemon = True
+                self.__threads.append(thread)
+                thread.start()
+
+    def __work(self):
+        """Run tasks from the queue forever, skipping ones already claimed."""
+
+        while 1:
+            priority, round, sequence, task = self.__queue.get()
+
+            with self.__lock:
+                self.__round = max(self.__round, round)
+
+                # forget about groups once they have nothing left queued
+                group = task.scheduling[1]
+                if group is not None:
+                    last_round, count = self.__groups[group]
+                    if count > 1:
+                        self.__groups[group] = (last_round, count - 1)
+                    else:
+                        del self.__groups[group]
+
+            if task.claim():
+                task.run()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call of function with the given args and return its Task."""
+
+        task = Task(function, args, kwargs)
+        self.__enqueue(task)
+        return task
+
+    def submit_after(self, tasks, function, *args, **kwargs):
+        """
+        Queue a call of function once every one of tasks has finished, and
+        return its Task. The call gets the list of the tasks' Outcomes ahead
+        of args. No thread is tied up waiting for the tasks to finish.
+        """
+
+        tasks = list(tasks)
+
+        def call(*args, **kwargs):
+            # only needed if the task is run early by someone joining it
+            for t in tasks:
+                t.wait()
+            return function([t.outcome() for t in tasks], *args, **kwargs)
+
+        task = Task(call, args, kwargs)
+
+        # queue the call when the last of the tasks finishes
+        remaining = [len(tasks)]
+        remaining_lock = threading.Lock()
+        def finished(t):
+            with remaining_lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self.__enqueue(task)
+
+        if not tasks:
+            self.__enqueue(task)
+        for t in tasks:
+            t.add_done_callback(finished)
+
+        return task
+
+    def __enqueue(self, task):
+        """Put a task in the queue according to its scheduling."""
+
+        if len(self.__threads) < self.size:
+            self.__start()
+
+        priority, group = task.scheduling
+
+        with self.__lock:
+            # ungrouped tasks are simply queued in the current round
+            round = self.__round
+            if group is not None:
+                last_round, count = self.__groups.get(group, (round - 1, 0))
+                round = max(last_round + 1, round)
+                self.__groups[group] = (round, count + 1)
+
+            sequence = self.__sequence.next()
+
+        self.__queue.put((priority, round, sequence, task))
+
+    def map(self, function, sequence, limit=None):
+        """
+        Map a function onto a sequence using the pool's threads. Blocks until
+        results are ready, and returns them in the order of the original
+        sequence. If limit is given, no more than that many items are queued
+        or running at once.
+        """
+
+        return list(self.imap(function, sequence, limit=limit))
+
+    def map_outcomes(self, function, sequence, fail_fast=False, deadline=None):
+        """
+        Like map, but never raises. Returns an Outcome for every item in the
+        order of the original sequence. If fail_fast is True, the first item
+        to raise cancels every item that hasn't started running yet. If a
+        deadline (an absolute time.time() value) is given, this returns once
+        it passes, and items that haven't finished by then are marked as
+        timed out and left to finish in the background. Items are then only
+        ever run by the pool's own threads.
+        """
+
+        tasks = [self.submit(function, item) for item in sequence]
+
+        if fail_fast:
+            def cancel_rest(task):
+                if task.exc_info is not None:
+                    for t in tasks:
+                        t.cancel()
+
+            for task in tasks:
+                task.add_done_callback(cancel_rest)
+
+        return outcomes(tasks, deadline=deadline)
+
+    def imap(self, function, iterable, limit=None):
+        """
+        Like map, but returns a generator that yields each result as soon as
+        it and every result before it are ready. Items are pulled from the
+        iterable lazily, so if limit is given, no more than that many are held
+        at once and the iterable may be arbitrarily long.
+        """
+
+        iterator = iter(iterable)
+
+        # keep a sliding window of at most 'limit' submitted tasks
+        pending = collections.deque()
+        for item in iterator:
+            pending.append(self.submit(function, item))
+            if limit is not None and len(pending) >= limit:
+                yield pending.popleft().join()
+
+        while pending:
+            yield pending.popleft().join()
+
+    def imap_unordered(self, function, iterable, limit=None):
+        """
+        Map a function onto an iterable and yield (index, result) tuples in the
+        order the items finish, where index is the item's position in the
+        original iterable. Items are pulled lazily as earlier ones finish, so
+        if limit is given, no more than that many are in flight at once. If the
+        generator is closed early, items that haven't started are cancelled.
+        """
+
+        iterator = enumerate(iterable)
+
+        # every task reports its index here when it's done
+        done_queue = queue.Queue()
+        tasks = {}
+
+        def fill():
+            """Submit items until the window is full or there are no more."""
+
+            while limit is None or len(tasks) < limit:
+                try:
+                    index, item = iterator.next()
+                except StopIteration:
+                    return
+
+                task = self.submit(function, item)
+                task.add_done_callback(lambda t, i=index: done_queue.put(i))
+                tasks[index] = task
+
+        fill()
+        try:
+            while tasks:
+                # while nothing is done, run our own tasks no worker has taken
+                while (done_queue.empty() and
+                        Pool.__run_unclaimed(tasks.values())):
+                    pass
+
+                index = done_queue.get()
+                task = tasks.pop(index)
+
+                # top the window up before handing the result back
+                fill()
+                yield index, task.join()
+        finally:
+            # if we're stopped early, don't bother with work nobody has started
+            for task in tasks.values():
+                task.cancel()
+
+    @staticmethod
+    def __run_unclaimed(tasks):
+        """Run the first unclaimed task. Returns whether one was run."""
+
+        for task in tasks:
+            if task.claim():
+                task.run()
+                return True
+        return False
+
+class ProcessPool(object):
+    """
+    A pool of worker processes with the same map interface as Pool, for
+    CPU-bound work that would otherwise serialize on the GIL. The mapped
+    function and every item must be picklable. The processes are forked when
+    the pool is created, so create it before starting any threads.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = multiprocessing.cpu_count()
+        assert size > 0
+
+        self.size = size
+        self.__pool = multiprocessing.Pool(size)
+
+    def map(self, function, sequence, limit=None):
+        """
+        Map a function onto a sequence using the pool's processes. Blocks until
+        results are ready, and returns them in the order of the original
+        sequence. If limit is given, no more than that many items are sent to
+        the processes at once.
+        """
+
+        items = list(sequence)
+        if limit is None:
+            limit = max(len(items), 1)
+        assert limit > 0
+
+        results = []
+        for i in xrange(0, len(items), limit):
+            results.extend(self.__pool.map(function, items[i:i + limit]))
+
+        return results
+
+    def close(self):
+        """Stop the worker processes once they finish any outstanding work."""
+
+        self.__pool.close()
+        self.__pool.join()
+
+class Scheduler(object):
+    """
+    Calls functions once a delay has passed, all from a single background
+    thread, so that waiting to do something doesn't tie up a thread of its
+    own. The calls should be quick, like submitting a task to a pool.
+    """
+
+    def __init__(self):
+        # holds (time to run at, sequence number, task) tuples
+        self.__heap = []
+        self.__sequence = itertools.count()
+
+        self.__thread = None
+        self.__condition = threading.Condition()
+
+    def call_later(self, delay, function, *args, **kwargs):
+        """
+        Call function with args after delay seconds, and return its Task. The
+        call can be prevented by cancelling the task before it runs.
+        """
+
+        task = Task(function, args, kwargs)
+        with self.__condition:
+            heapq.heappush(self.__heap,
+                    (time.time() + delay, self.__sequence.next(), task))
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__work)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+            self.__condition.notify()
+
+        return task
+
+    def __work(self):
+        """Run each task once its time comes, forever."""
+
+        while 1:
+            with self.__condition:
+                while not self.__heap or self.__heap[0][0] > time.time():
+                    timeout = None
+                    if self.__heap:
+                        timeout = self.__heap[0][0] - time.time()
+                    self.__condition.wait(timeout)
+
+                when, sequence, task = heapq.heappop(self.__heap)
+
+            if task.claim():
+                task.run()
+
+# the process-wide pool, created the first time it's asked for
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def shared_pool():
+    """Return the pool shared by everything in this process."""
+
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = Pool(DEFAULT_POOL_SIZE)
+        return _shared_pool